@@ -1,14 +1,30 @@
 import os
+import random
+import time
+from hashlib import sha1
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, url_for, make_response
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import or_, and_
+from sqlalchemy.orm import joinedload, selectinload, lazyload
 
 from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm
-from models import db, connect_db, User, Message, Follows, Like
-
-CURR_USER_KEY = "curr_user"
+from models import (db, connect_db, User, Message, Follows, Like, Timeline,
+                    page_query, PAGE_SIZE)
+from instrumentation import init_instrumentation
+from assets import init_assets
+from images import init_images
+from recorder import init_traffic_log
+from fragments import init_fragments, fragment_cache
+from current_user import CurrentUser, profile_cache, CURR_USER_KEY
+from passwords import PasswordHasherBusy
+from likes import like_buffer
+from streaming import stream_template, StreamedRows, StreamedMessages
+from search import (search_users, list_users_after, typeahead_users,
+                    search_messages, index_message, unindex_message)
+
+# Session key: until when (epoch seconds) to read from the primary
+PRIMARY_UNTIL_KEY = "read_primary_until"
 
 app = Flask(__name__)
 
@@ -21,9 +37,85 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Read replicas, as a comma-separated READ_REPLICA_URLS. GET requests read
+# from one of them (see models.RoutingSession), except that for
+# REPLICA_PIN_SECONDS after a user's last write they read from the primary,
+# so they see it before it has reached the replicas.
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica{i}': url for i, url in enumerate(
+        url for url in os.environ.get('READ_REPLICA_URLS', '').split(',')
+        if url)
+}
+app.config['READ_REPLICAS'] = list(app.config['SQLALCHEMY_BINDS'])
+app.config['REPLICA_PIN_SECONDS'] = 10
+
+# How each message list loads its authors, by endpoint: 'joined' adds them
+# to the page query, 'selectin' fetches them in one extra query, 'lazy'
+# loads each one on first access (fine when every message has one author).
+app.config['MESSAGE_AUTHOR_LOADING'] = {
+    'homepage': 'joined',
+    'users_show': 'lazy',
+    'show_likes': 'joined',
+}
+
+# bcrypt cost for new hashes; logins rehash passwords stored at other costs
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# threads hashing passwords, how many hashes may be in flight, and how
+# long (seconds) one may take before logins/signups are turned away with
+# a 503
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_QUEUE'] = 8
+app.config['PASSWORD_HASH_TIMEOUT'] = 10
+
+# How long (seconds) g.user's profile fields may be served from cache
+app.config['USER_CACHE_TTL'] = 30
+
+# Plain /static/ files are served with this max-age; built assets under
+# /static/dist/ are fingerprinted and cached for a year (see assets.py)
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 24 * 60 * 60
+
+# Resized profile images (see images.py) are kept on disk up to this size
+app.config['IMAGE_CACHE_DIR'] = os.environ.get(
+    'IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'image-cache'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = 256 * 1024 * 1024
+
+# Rendered message list items kept in memory per worker (see fragments.py)
+app.config['FRAGMENT_CACHE_SIZE'] = 10000
+
+# Render long pages while sending them (see streaming.py), reading their
+# rows from the database this many at a time
+app.config['STREAM_TEMPLATES'] = os.environ.get('STREAM_TEMPLATES') != '0'
+app.config['STREAM_BATCH_SIZE'] = 50
+
+# Buffer star clicks and write them in batches (see likes.py): every
+# LIKE_FLUSH_INTERVAL seconds, or once LIKE_FLUSH_SIZE are waiting
+app.config['LIKE_WRITE_BEHIND'] = os.environ.get('LIKE_WRITE_BEHIND') == '1'
+app.config['LIKE_FLUSH_INTERVAL'] = 0.5
+app.config['LIKE_FLUSH_SIZE'] = 500
+
+# Append sampled requests to this JSONL file for replaying against other
+# builds (see recorder.py and loadtest/replay.py). Users are sampled, at
+# this rate, and recorded under an HMAC of their id keyed by
+# TRAFFIC_LOG_SECRET (SECRET_KEY if unset).
+app.config['TRAFFIC_LOG'] = os.environ.get('TRAFFIC_LOG')
+app.config['TRAFFIC_SAMPLE_RATE'] = float(
+    os.environ.get('TRAFFIC_SAMPLE_RATE', 1.0))
+app.config['TRAFFIC_LOG_SECRET'] = os.environ.get('TRAFFIC_LOG_SECRET')
+
+# Opt-in per-request SQL counts/timings (Server-Timing header + log line)
+app.config['SQL_INSTRUMENTATION'] = (
+    os.environ.get('SQL_INSTRUMENTATION') == '1')
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+init_instrumentation(app)
+init_assets(app)
+init_images(app)
+init_fragments(app)
+init_traffic_log(app)
+like_buffer.init_app(app)
 
 
 #############################################################################
@@ -32,14 +124,41 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a lazy CurrentUser; the database is only queried when the
+    request needs more than the cached profile fields.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = CurrentUser(session[CURR_USER_KEY],
+                             ttl=app.config['USER_CACHE_TTL'])
 
     else:
         g.user = None
 
+
+@app.before_request
+def route_reads():
+    """Read from a replica on GETs, unless this session wrote recently."""
+
+    replicas = app.config['READ_REPLICAS']
+
+    if (replicas and request.method in ('GET', 'HEAD')
+            and session.get(PRIMARY_UNTIL_KEY, 0) < time.time()):
+        db.session.info['replica'] = random.choice(replicas)
+
+
+@app.after_request
+def pin_to_primary(response):
+    """After a write, read from the primary for a while."""
+
+    if app.config['READ_REPLICAS'] and request.method not in ('GET', 'HEAD'):
+        session[PRIMARY_UNTIL_KEY] = (time.time()
+                                      + app.config['REPLICA_PIN_SECONDS'])
+
+    return response
+
 # HELPER FUNCTIONS
 
 
@@ -55,6 +174,116 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+
+def viewer_following_ids(users):
+    """Which of `users` the logged-in user follows, as a set of ids."""
+
+    if not g.user:
+        return set()
+
+    return g.user.following_ids([user.id for user in users])
+
+
+def make_etag(*parts):
+    """ETag for a page built from the data versions in `parts`.
+
+    Pages are sent weak ETags: the same page is gzipped or not depending on
+    the client (see streaming.py), so the bytes aren't the same.
+    """
+
+    return sha1(repr(parts).encode()).hexdigest()
+
+
+def not_modified(etag):
+    """A 304 response if the client already has `etag`, else None.
+
+    Checked before a page does its real work, so a revalidation costs only
+    the lookups needed to build the ETag.
+    """
+
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+def with_etag(body, etag):
+    """Response for `body` that clients may revalidate with `etag`."""
+
+    response = make_response(body)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def conditional_json(**data):
+    """JSON response with an ETag, answered with 304 when it matches."""
+
+    response = jsonify(**data)
+    response.add_etag()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+AUTHOR_LOADERS = {
+    'joined': joinedload,
+    'selectin': selectinload,
+    'lazy': lazyload,
+}
+
+
+def with_authors(query):
+    """Load message authors the way this endpoint is configured to."""
+
+    strategy = app.config['MESSAGE_AUTHOR_LOADING'].get(request.endpoint,
+                                                        'selectin')
+    return query.options(AUTHOR_LOADERS[strategy](Message.user))
+
+
+def viewer_liked_ids(messages):
+    """Which of `messages` the logged-in user liked, as a set of ids."""
+
+    if not g.user or not messages:
+        return set()
+
+    ids = [msg.id for msg in messages]
+    liked_ids = g.user.liked_ids(ids)
+
+    if app.config['LIKE_WRITE_BEHIND']:
+        liked_ids = like_buffer.overlay(g.user.id, liked_ids, ids)
+
+    return liked_ids
+
+
+def viewer_pending_likes():
+    """The logged-in user's likes not yet written, for page ETags."""
+
+    if not g.user or not app.config['LIKE_WRITE_BEHIND']:
+        return ()
+
+    return like_buffer.pending(g.user.id)
+
+
+def streamed_messages(query, liked_ids):
+    """Stream a page_query's messages, adding the viewer's likes among each
+    batch to `liked_ids` as it's read."""
+
+    return StreamedMessages(
+        query, app.config['STREAM_BATCH_SIZE'],
+        on_batch=lambda batch: liked_ids.update(viewer_liked_ids(batch)),
+        limit=PAGE_SIZE)
+
+
+def streamed_users(query, following_ids):
+    """Stream `query`'s users, adding the ones the viewer follows among each
+    batch to `following_ids` as it's read."""
+
+    return StreamedRows(
+        query, app.config['STREAM_BATCH_SIZE'],
+        on_batch=lambda batch: following_ids.update(
+            viewer_following_ids(batch)))
+
 # ROUTE FUNCTIONS
 
 
@@ -105,6 +334,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # commits a rehashed password if the bcrypt cost changed
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -114,6 +345,14 @@ def login():
     return render_template('users/login.html', form=form)
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Turn away logins/signups while the password hasher is saturated."""
+
+    return ("Too many sign-ins in progress, please try again shortly.", 503,
+            {'Retry-After': '1'})
+
+
 @app.route('/logout')
 def logout():
     """Handle logout of user."""
@@ -130,39 +369,66 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, with
+    'page' for further pages of results. Without 'q' the whole directory is
+    paged by 'after' (the last user id shown).
     """
 
-    search = request.args.get('q')
+    search = request.args.get('q', '').strip()
 
     if not search:
-        users = User.query.all()
+        users, after = list_users_after(request.args.get('after', type=int))
+        next_url = after and url_for('list_users', after=after)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = max(request.args.get('page', 1, type=int), 1)
+        users, has_next = search_users(search, page)
+        next_url = has_next and url_for('list_users', q=search, page=page + 1)
 
-    return render_template('users/index.html', users=users)
+    return stream_template('users/index.html', users=users,
+                           following_ids=viewer_following_ids(users),
+                           next_url=next_url)
+
+
+@app.route('/users/typeahead')
+def users_typeahead():
+    """Username suggestions (JSON) for the search box, by prefix."""
+
+    users = typeahead_users(request.args.get('q', ''))
+
+    return jsonify(users=[dict(id=user.id,
+                               username=user.username,
+                               image_url=user.image_url)
+                          for user in users])
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Messages are paged newest first; pass the previous page's cursor as
+    'before' in the querystring to load the next one.
+    """
 
     user = User.query.get_or_404(user_id)
 
+    etag = make_etag('users_show', user.id, user.version,
+                     g.user and g.user.id, g.user and g.user.version,
+                     viewer_pending_likes(), request.args.get('before'))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    
-    print("****User.messages.timestamp")
-
-    likes = g.user.liked_messages
+    liked_ids = set()
+    messages = streamed_messages(
+        page_query(with_authors(Message.query.filter(Message.user_id == user_id)),
+                   request.args.get('before')),
+        liked_ids)
 
-    return render_template('users/show.html', g_user=g.user, user=user, messages=messages, likes=likes)
+    return with_etag(stream_template('users/show.html', user=user,
+                                     messages=messages, liked_ids=liked_ids),
+                     etag)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -174,7 +440,17 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+
+    following_ids = set()
+    following = streamed_users(
+        User.query
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == user_id)
+        .order_by(Follows.user_being_followed_id),
+        following_ids)
+
+    return stream_template('users/following.html', user=user,
+                           following=following, following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -186,49 +462,80 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+
+    following_ids = set()
+    followers = streamed_users(
+        User.query
+        .join(Follows, Follows.user_following_id == User.id)
+        .filter(Follows.user_being_followed_id == user_id)
+        .order_by(Follows.user_following_id),
+        following_ids)
+
+    return stream_template('users/followers.html', user=user,
+                           followers=followers, following_ids=following_ids)
+
+
+def follow_response(followed_id, following, changed):
+    """JSON with the new follow state and both users' updated counts.
+
+    Sent back so the page can update without asking for the counts.
+    """
+
+    counts = {id: (following_count, followers_count)
+              for id, following_count, followers_count
+              in db.session.query(User.id, User.following_count,
+                                  User.followers_count)
+              .filter(User.id.in_([g.user.id, followed_id]))}
+
+    return jsonify(dbupdate=True,
+                   following=following,
+                   changed=changed,
+                   following_count=counts[g.user.id][0],
+                   followers_count=counts[followed_id][1])
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
+    """Add a follow for the currently-logged-in user.
+
+    Following someone already followed changes nothing.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    # referer = request.headers.get("Referer")
     try:
-        followed_user = User.query.get_or_404(follow_id)
-        g.user.following.append(followed_user)
+        changed = Follows.add(g.user.id, follow_id)
+        response = follow_response(follow_id, True, changed)
         db.session.commit()
     except:
+        db.session.rollback()
         return jsonify(error="error in database. unable to update following status.")
-    
-    return jsonify(dbupdate=True)
 
-    # return redirect(referer)
+    return response
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
+    """Have currently-logged-in-user stop following this user.
+
+    Unfollowing someone not followed changes nothing.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    # referer = request.headers.get("Referer")
     try:
-        followed_user = User.query.get(follow_id)
-        g.user.following.remove(followed_user)
+        changed = Follows.remove(g.user.id, follow_id)
+        response = follow_response(follow_id, False, changed)
         db.session.commit()
     except:
+        db.session.rollback()
         return jsonify(error="error in database. unable to update following status.")
 
-    return jsonify(dbupdate=True)
-
-    # return redirect(referer)  # old version: /users/{g.user.id}/following")
+    return response
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -244,16 +551,19 @@ def profile():
     form = UserUpdateForm(obj=g.user)
 
     if form.validate_on_submit():
-        user = User.authenticate(g.user.username, form.password.data)
-        if user:
+        user = g.user._get_current_object()
+        if user.check_password(form.password.data):
             user.username = form.username.data
             user.email = form.email.data
             user.image_url = form.image_url.data
             user.header_image_url = form.header_image_url.data
             user.bio = form.bio.data
             user.location = form.location.data
+            user.version = User.version + 1
+            user.profile_version = User.profile_version + 1
 
             db.session.commit()
+            profile_cache.invalidate(user.id)
             return redirect(f'/users/{user.id}')
         else:
             flash('Wrong password!')
@@ -272,24 +582,53 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # the cascades below won't touch the counters of the users on the other
+    # side of our follows and likes
+    User.adjust_counts(
+        db.select([Follows.user_being_followed_id])
+        .where(Follows.user_following_id == g.user.id),
+        followers_count=-1)
+    User.adjust_counts(
+        db.select([Follows.user_following_id])
+        .where(Follows.user_being_followed_id == g.user.id),
+        following_count=-1)
+    # a user may have liked several of our messages: subtract how many,
+    # not 1
+    our_likes = Like.__table__.join(Message.__table__)
+    User.adjust_counts(
+        db.select([Like.user_id]).select_from(our_likes)
+        .where(Message.user_id == g.user.id),
+        likes_count=-db.select([db.func.count()]).select_from(our_likes)
+        .where(Message.user_id == g.user.id)
+        .where(Like.user_id == User.id)
+        .as_scalar())
+
+    db.session.delete(g.user._get_current_object())
     db.session.commit()
+    profile_cache.invalidate(g.user.id)
 
     return redirect("/signup")
 
 
 @app.route('/users/<int:user_id>/likes')
 def show_likes(user_id):
-    """Show all the likes messages of a user"""
+    """Show all the likes messages of a user, paged like the profile"""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    likes = g.user.liked_messages
-
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, likes=likes)
+
+    liked_ids = set()
+    messages = streamed_messages(
+        page_query(with_authors(Message.query.join(Like)
+                                .filter(Like.user_id == user_id)),
+                   request.args.get('before')),
+        liked_ids)
+
+    return stream_template('users/likes.html', user=user, messages=messages,
+                           liked_ids=liked_ids)
 
 @app.route('/users/<int:user_id>/likes_count')
 def return_like_count(user_id):
@@ -300,8 +639,10 @@ def return_like_count(user_id):
 
     user = User.query.get(user_id)
     if user:
-        count = len(user.liked_messages)
-        return jsonify(count=count)
+        count = user.likes_count
+        if user_id == g.user.id and app.config['LIKE_WRITE_BEHIND']:
+            count += like_buffer.count_delta(user_id)
+        return conditional_json(count=count)
     else:
         return jsonify(error="No user found")
 
@@ -314,8 +655,8 @@ def return_following_count(user_id):
 
     user = User.query.get(user_id)
     if user:
-        count = len(user.following)
-        return jsonify(count=count)
+        count = user.following_count
+        return conditional_json(count=count)
     else:
         return jsonify(error="No user found")
 
@@ -328,8 +669,8 @@ def return_followers_count(user_id):
 
     user = User.query.get(user_id)
     if user:
-        count = len(user.followers)
-        return jsonify(count=count)
+        count = user.followers_count
+        return conditional_json(count=count)
     else:
         return jsonify(error="No user found")
 
@@ -352,18 +693,46 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        User.adjust_counts(g.user.id, messages_count=1)
+        db.session.flush()
+        Timeline.fan_out(msg)
         db.session.commit()
+        index_message(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search message text; 'q' is the search, 'page' the results page."""
+
+    search = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    messages, has_next = search_messages(search, page)
+    next_url = has_next and url_for('messages_search', q=search, page=page + 1)
+
+    return render_template('messages/search.html', search=search,
+                           messages=messages,
+                           liked_ids=viewer_liked_ids(messages),
+                           next_url=next_url)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.query.get_or_404(message_id)
+
+    etag = make_etag('messages_show', msg.id, msg.user.version,
+                     g.user and g.user.id, g.user and g.user.version,
+                     viewer_pending_likes())
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    return with_etag(render_template('messages/show.html', message=msg), etag)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -375,38 +744,60 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    User.adjust_counts(msg.user_id, messages_count=-1)
+    User.adjust_counts(
+        db.select([Like.user_id]).where(Like.message_id == msg.id),
+        likes_count=-1)
+    unindex_message(msg)
     db.session.delete(msg)
     db.session.commit()
+    fragment_cache.evict_message(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 @app.route('/messages/<int:message_id>/like', methods=['POST'])
 def message_like(message_id):
+    """Like or unlike a message.
+
+    A JSON body of {"liked": true|false} sets the state, so repeating the
+    request changes nothing; without one the like is toggled. With
+    LIKE_WRITE_BEHIND the change is buffered and written shortly after.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    
-    try: 
-        message = Message.query.get(message_id)
-        if message in g.user.liked_messages:
-            Like.query.filter(and_(Like.user_id == g.user.id,
-                                Like.message_id == message_id)).delete()
-        else:
-            like = Like(user_id=g.user.id, message_id=message_id)
-            db.session.add(like)
 
-        db.session.commit()
-    except: 
-        return jsonify(dbupdate=False)
-    
+    liked = (request.get_json(silent=True) or {}).get('liked')
+
+    if app.config['LIKE_WRITE_BEHIND']:
+        # the buffer would only find out when its flush hit the foreign key
+        Message.query.get_or_404(message_id)
 
-    return jsonify(dbupdate=True)
+        liked, changed = like_buffer.set(g.user.id, message_id, liked)
+        likes_count = g.user.likes_count + like_buffer.count_delta(g.user.id)
+        return jsonify(dbupdate=True, liked=liked, changed=changed,
+                       likes_count=likes_count)
 
-    # referer = request.headers.get("Referer")
+    try:
+        if liked is None:
+            liked = not Like.remove(g.user.id, message_id)
+            changed = Like.add(g.user.id, message_id) if liked else True
+        elif liked:
+            changed = Like.add(g.user.id, message_id)
+        else:
+            changed = Like.remove(g.user.id, message_id)
 
-    # return redirect(referer)
+        likes_count = (db.session.query(User.likes_count)
+                       .filter(User.id == g.user.id)
+                       .scalar())
+        db.session.commit()
+    except:
+        db.session.rollback()
+        return jsonify(dbupdate=False)
 
+    return jsonify(dbupdate=True, liked=bool(liked), changed=changed,
+                   likes_count=likes_count)
 
 # @app.route('/messages/<int:message_id>/unlike', methods=['POST'])
 # def message_unlike(message_id):
@@ -425,6 +816,35 @@ def message_like(message_id):
 #     return redirect(referer)
 
 
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations (see migrations.py)."""
+
+    from migrations import apply_migrations
+
+    applied = apply_migrations()
+    print(f"Applied migrations: {applied or 'none pending'}")
+
+
+@app.cli.command('recount')
+def recount_command():
+    """Rebuild the denormalized user counters from their source tables."""
+
+    User.recount()
+    db.session.commit()
+
+
+@app.cli.command('trim-timelines')
+def trim_timelines_command():
+    """Trim home timelines grown by new messages back to their length."""
+
+    Timeline.trim_all()
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -434,41 +854,36 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, read from the
+      user's materialized timeline; 'before' in the querystring pages back
     """
 
     if g.user:
-        following_ids = [user.id for user in g.user.following] + [g.user.id]
-        for user in g.user.following:
-            following_ids.append(user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        
-        likes = g.user.liked_messages
-
-        return render_template('home.html', messages=messages, likes=likes, user=g.user)
+        liked_ids = set()
+        messages = streamed_messages(
+            Timeline.page_query(g.user.id, request.args.get('before'),
+                                options=with_authors),
+            liked_ids)
+
+        return stream_template('home.html', messages=messages,
+                               liked_ids=liked_ids)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Cache policy
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Routes that can be revalidated set their own Cache-Control along with an
+# ETag (see with_etag/conditional_json), and static files get a max-age
+# from SEND_FILE_MAX_AGE_DEFAULT. Everything else (forms, flashed
+# messages, redirects) is never stored.
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to responses without a cache policy."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
+    if 'Cache-Control' not in req.headers:
+        req.headers['Cache-Control'] = 'no-store'
     return req
@@ -0,0 +1,459 @@
+"""Serve Warbler over ASGI, answering the small JSON endpoints on asyncio.
+
+    uvicorn asgi:application --workers 2
+
+The count, follow and like endpoints that warbler.js calls after every
+click run as coroutines on an asyncpg pool, so a few processes can keep
+thousands of them in flight. Everything else, including those endpoints
+when they need more than a quick answer (logged out or deleted users,
+self-follows, write-behind likes), is passed to the Flask app via asgiref.
+Both read the same session cookie, so a login works for either. The WSGI
+entry point (gunicorn app:app) keeps working unchanged.
+
+The native endpoints run on the primary database, as of DATABASE_URL,
+and need asyncpg and Postgres. Without them, every request goes to Flask.
+Their writes are the statements models.py builds for Follows.add/remove,
+Like.add/remove, Timeline.backfill/prune and User.adjust_counts, compiled
+for asyncpg once at import. What Flask's after_request hooks do for the
+rest is done here too: sampled requests go to the traffic log (see
+recorder.py), SQL_INSTRUMENTATION adds Server-Timing and a log line (see
+instrumentation.py), and responses get the same Cache-Control.
+"""
+
+import json
+import re
+import time
+from contextlib import asynccontextmanager
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy.dialects import postgresql
+from flask import jsonify
+from werkzeug.http import generate_etag, parse_cookie, parse_etags
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from app import app, PRIMARY_UNTIL_KEY
+from current_user import CURR_USER_KEY, load_session, session_cookie
+from instrumentation import QueryStats, log_request
+from models import (db, User, Follows, Like, Timeline,
+                    insert_ignore_statement, delete_row_statement)
+
+# Connections each process keeps to the database
+app.config.setdefault('ASYNC_DB_POOL_SIZE', 10)
+
+# Largest request body read, for the like endpoint's {"liked": ...}
+MAX_BODY = 1024
+
+# Postgres with numbered parameters, which Statement turns into $n
+DIALECT = postgresql.dialect(paramstyle='numeric')
+
+
+class Statement:
+    """A SQLAlchemy statement compiled once for asyncpg."""
+
+    def __init__(self, statement):
+        self.compiled = statement.compile(dialect=DIALECT)
+        self.sql = re.sub(r'(?<![:\w]):(\d+)', r'$\1', self.compiled.string)
+
+    def args(self, **values):
+        """Positional arguments for the statement's bound `values`."""
+
+        params = self.compiled.construct_params(values)
+        return [params[name] for name in self.compiled.positiontup]
+
+
+P = db.bindparam
+
+# the logged-in user, locked against deletion until the write commits
+VIEWER = Statement(db.select([User.id])
+                   .where(User.id == P('user_id'))
+                   .with_for_update(read=True, key_share=True))
+
+COUNTS = {
+    kind: Statement(db.select([
+        db.select([column]).where(User.id == P('user_id'))
+        .as_scalar().label('count'),
+        db.exists().where(User.id == P('viewer_id')).label('viewer'),
+    ]))
+    for kind, column in (('likes', User.likes_count),
+                         ('following', User.following_count),
+                         ('followers', User.followers_count))
+}
+
+FOLLOW = Statement(insert_ignore_statement(
+    Follows.__table__, 'postgresql',
+    user_being_followed_id=P('followed_id'),
+    user_following_id=P('follower_id')))
+UNFOLLOW = Statement(delete_row_statement(
+    Follows.__table__,
+    user_being_followed_id=P('followed_id'),
+    user_following_id=P('follower_id')))
+BACKFILL = [Statement(statement) for statement in
+            Timeline.backfill_statements(P('follower_id'), P('followed_id'))]
+PRUNE = Statement(Timeline.prune_statement(P('follower_id'),
+                                           P('followed_id')))
+FOLLOW_COUNTS = Statement(
+    db.select([User.id, User.following_count, User.followers_count])
+    .where(User.id.in_([P('follower_id'), P('followed_id')])))
+
+LIKE = Statement(insert_ignore_statement(
+    Like.__table__, 'postgresql',
+    user_id=P('user_id'), message_id=P('message_id')))
+UNLIKE = Statement(delete_row_statement(
+    Like.__table__, user_id=P('user_id'), message_id=P('message_id')))
+LIKES_COUNT = Statement(db.select([User.likes_count])
+                        .where(User.id == P('user_id')))
+
+ADJUST_COUNTS = {
+    name: Statement(User.adjust_counts_statement(P('user_id'),
+                                                 **{name: P('delta')}))
+    for name in ('following_count', 'followers_count', 'likes_count')
+}
+
+
+def postgres_dsn(uri):
+    """`uri` as asyncpg wants it, or None if it isn't a Postgres one."""
+
+    dsn, matched = re.subn(r'^postgres(ql)?(\+\w+)?://', 'postgresql://', uri)
+    return dsn if matched else None
+
+
+class JSONEndpoints:
+    """The ASGI application: native JSON endpoints, Flask for the rest."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.dsn = postgres_dsn(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+        self.pool = None
+
+        self.routes = [
+            ('GET', r'/users/(\d+)/(likes|following|followers)_count$',
+             self.count),
+            ('POST', r'/users/(follow|stop-following)/(\d+)$', self.follow),
+            ('POST', r'/messages/(\d+)/like$', self.like),
+        ]
+        self.routes = [(method, re.compile(pattern), endpoint)
+                       for method, pattern, endpoint in self.routes]
+
+    @property
+    def native(self):
+        return asyncpg is not None and self.dsn is not None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] == 'http' and self.native:
+            for method, pattern, endpoint in self.routes:
+                match = pattern.match(scope['path'])
+                if match and scope['method'] == method:
+                    request = Request(self.flask_app, scope, receive)
+                    if request.user_id is not None:
+                        response = await endpoint(request, *match.groups())
+                        if response is not None:
+                            return await self.respond(request, endpoint,
+                                                      response, send)
+
+                    # not something we answer here: replay what was read
+                    # of the request to Flask, which records and times it
+                    return await self.wsgi(scope, request.replay, send)
+
+        return await self.wsgi(scope, receive, send)
+
+    async def respond(self, request, endpoint, response, send):
+        """Send `response`, timing and recording it as Flask would."""
+
+        stats = request.stats
+        if stats is not None:
+            response.headers.append(
+                (b'server-timing', stats.server_timing().encode()))
+            log_request(self.flask_app.logger, stats,
+                        method=request.scope['method'],
+                        path=request.scope['path'],
+                        endpoint=f'asgi.{endpoint.__name__}',
+                        status=response.status)
+
+        await response.send(send)
+
+        if request.entry is not None:
+            self.flask_app.extensions['traffic_recorder'].finish(
+                request.entry, response.status, len(response.body))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                if self.native:
+                    self.pool = await asyncpg.create_pool(
+                        self.dsn, min_size=1,
+                        max_size=self.flask_app.config['ASYNC_DB_POOL_SIZE'])
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                if self.pool is not None:
+                    await self.pool.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @asynccontextmanager
+    async def connect(self, request):
+        """A pooled Connection, timing statements for `request`."""
+
+        async with self.pool.acquire() as conn:
+            yield Connection(conn, request.stats)
+
+    async def count(self, request, user_id, kind):
+        """likes_count, following_count and followers_count."""
+
+        user_id = int(user_id)
+        if (kind == 'likes' and user_id == request.user_id
+                and self.flask_app.config['LIKE_WRITE_BEHIND']):
+            # pending likes live in the Flask side's buffer
+            return None
+
+        async with self.connect(request) as conn:
+            row = await conn.fetchrow(COUNTS[kind], user_id=user_id,
+                                      viewer_id=request.user_id)
+
+        if not row['viewer']:
+            return None
+
+        if row['count'] is None:
+            return JSONResponse(self.flask_app, dict(error="No user found"))
+
+        return JSONResponse(self.flask_app, dict(count=row['count']),
+                            conditional=request)
+
+    async def follow(self, request, action, followed_id):
+        """/users/follow/<id> and /users/stop-following/<id>."""
+
+        ids = dict(follower_id=request.user_id, followed_id=int(followed_id))
+        following = action == 'follow'
+
+        if ids['follower_id'] == ids['followed_id']:
+            # Follows.add refuses these
+            return None
+
+        try:
+            async with self.connect(request) as conn:
+                async with conn.transaction():
+                    if not await conn.fetchrow(VIEWER,
+                                               user_id=ids['follower_id']):
+                        return None
+
+                    if following:
+                        changed = await conn.execute(FOLLOW, **ids)
+                    else:
+                        changed = await conn.execute(UNFOLLOW, **ids)
+
+                    if changed:
+                        delta = 1 if following else -1
+                        await conn.execute(ADJUST_COUNTS['following_count'],
+                                           user_id=ids['follower_id'],
+                                           delta=delta)
+                        await conn.execute(ADJUST_COUNTS['followers_count'],
+                                           user_id=ids['followed_id'],
+                                           delta=delta)
+
+                        for statement in (BACKFILL if following else [PRUNE]):
+                            await conn.execute(statement, **ids)
+
+                    counts = {row['id']: row for row in
+                              await conn.fetch(FOLLOW_COUNTS, **ids)}
+                    follower = counts[ids['follower_id']]
+                    followed = counts[ids['followed_id']]
+        except (asyncpg.PostgresError, KeyError):
+            return JSONResponse(self.flask_app, dict(
+                error="error in database. unable to update following status."))
+
+        return self.wrote(request, JSONResponse(self.flask_app, dict(
+            dbupdate=True,
+            following=following,
+            changed=bool(changed),
+            following_count=follower['following_count'],
+            followers_count=followed['followers_count'])))
+
+    async def like(self, request, message_id):
+        """/messages/<id>/like: a JSON {"liked": bool} sets it, else toggle."""
+
+        if self.flask_app.config['LIKE_WRITE_BEHIND']:
+            return None
+
+        ids = dict(user_id=request.user_id, message_id=int(message_id))
+
+        try:
+            liked = json.loads(await request.body() or 'null')
+        except ValueError:
+            liked = None
+        liked = liked.get('liked') if isinstance(liked, dict) else None
+
+        try:
+            async with self.connect(request) as conn:
+                async with conn.transaction():
+                    if not await conn.fetchrow(VIEWER,
+                                               user_id=ids['user_id']):
+                        return None
+
+                    if liked is None:
+                        liked = not await conn.execute(UNLIKE, **ids)
+                        changed = True
+                        if liked:
+                            changed = await conn.execute(LIKE, **ids)
+                    elif liked:
+                        changed = await conn.execute(LIKE, **ids)
+                    else:
+                        changed = await conn.execute(UNLIKE, **ids)
+
+                    if changed:
+                        await conn.execute(ADJUST_COUNTS['likes_count'],
+                                           user_id=ids['user_id'],
+                                           delta=1 if liked else -1)
+
+                    likes_count = (await conn.fetchrow(
+                        LIKES_COUNT, user_id=ids['user_id']))['likes_count']
+        except asyncpg.PostgresError:
+            return JSONResponse(self.flask_app, dict(dbupdate=False))
+
+        return self.wrote(request, JSONResponse(self.flask_app, dict(
+            dbupdate=True, liked=bool(liked), changed=bool(changed),
+            likes_count=likes_count)))
+
+    def wrote(self, request, response):
+        """Pin the user's reads to the primary after a write, as app.py's
+        pin_to_primary does."""
+
+        if self.flask_app.config['READ_REPLICAS']:
+            session = dict(request.session)
+            session[PRIMARY_UNTIL_KEY] = (
+                time.time() + self.flask_app.config['REPLICA_PIN_SECONDS'])
+            response.headers.append(
+                (b'set-cookie',
+                 session_cookie(self.flask_app, session).encode('latin-1')))
+
+        return response
+
+
+class Connection:
+    """An asyncpg connection running Statements, each one timed into
+    `stats` (a QueryStats, or None) as instrumentation.py does for
+    SQLAlchemy."""
+
+    def __init__(self, conn, stats):
+        self.conn = conn
+        self.stats = stats
+
+    def transaction(self):
+        return self.conn.transaction()
+
+    async def run(self, method, statement, values):
+        started = time.perf_counter()
+        try:
+            return await getattr(self.conn, method)(
+                statement.sql, *statement.args(**values))
+        finally:
+            if self.stats is not None:
+                self.stats.record(statement.sql,
+                                  time.perf_counter() - started)
+
+    async def execute(self, statement, **values):
+        """Run `statement`; returns how many rows it changed."""
+
+        status = await self.run('execute', statement, values)
+        # e.g. "INSERT 0 1", "DELETE 1"
+        return int(status.rsplit(' ', 1)[-1])
+
+    async def fetch(self, statement, **values):
+        return await self.run('fetch', statement, values)
+
+    async def fetchrow(self, statement, **values):
+        return await self.run('fetchrow', statement, values)
+
+
+class Request:
+    """What the native endpoints need of an ASGI HTTP request."""
+
+    def __init__(self, flask_app, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.headers = {name.decode('latin-1'): value.decode('latin-1')
+                        for name, value in scope['headers']}
+        self.session = load_session(
+            flask_app,
+            parse_cookie(self.headers.get('cookie', '')).get(
+                flask_app.session_cookie_name))
+        self.user_id = self.session.get(CURR_USER_KEY)
+        self._messages = []
+
+        self.stats = (QueryStats()
+                      if flask_app.config.get('SQL_INSTRUMENTATION') else None)
+
+        recorder = flask_app.extensions.get('traffic_recorder')
+        self.entry = recorder and recorder.start(
+            scope['method'], scope['path'],
+            scope['query_string'].decode('latin-1'),
+            self.headers.get('cookie', ''))
+
+    async def body(self):
+        """The request body, up to MAX_BODY bytes."""
+
+        body = b''
+        more = True
+        while more and len(body) <= MAX_BODY:
+            message = await self.receive()
+            self._messages.append(message)
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+
+        return body[:MAX_BODY]
+
+    async def replay(self):
+        """An ASGI receive giving back what body() read, then the rest."""
+
+        if self._messages:
+            return self._messages.pop(0)
+        return await self.receive()
+
+
+class JSONResponse:
+    """A JSON body, answered with 304 if `conditional`'s ETag matches.
+
+    The body and ETag are `flask_app`'s jsonify and Werkzeug's add_etag,
+    byte for byte, so a client can revalidate against either side.
+    Cache-Control is as app.py sets it: revalidated when there's an ETag,
+    else not stored.
+    """
+
+    def __init__(self, flask_app, data, conditional=None):
+        with flask_app.app_context():
+            response = jsonify(data)
+
+        self.body = response.get_data()
+        self.status = 200
+        self.headers = [(b'content-type',
+                         response.headers['Content-Type'].encode('latin-1'))]
+
+        if conditional is None:
+            self.headers.append((b'cache-control', b'no-store'))
+        else:
+            etag = generate_etag(self.body)
+            self.headers += [(b'etag', f'"{etag}"'.encode()),
+                             (b'cache-control', b'private, no-cache')]
+
+            if etag in parse_etags(conditional.headers.get('if-none-match')):
+                self.status = 304
+                self.body = b''
+
+    async def send(self, send):
+        await send({'type': 'http.response.start',
+                    'status': self.status,
+                    'headers': self.headers + [
+                        (b'content-length', str(len(self.body)).encode())]})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+application = JSONEndpoints(app)
@@ -0,0 +1,167 @@
+"""Fingerprinted, precompressed static assets for Warbler.
+
+Build step (run after changing anything in static/):
+
+    python assets.py
+
+Each asset is copied to static/dist/ with a hash of its contents in the
+filename, text assets also get .gz (and, with the brotli package, .br)
+siblings, and static/dist/manifest.json maps original paths to hashed
+ones. Templates link assets with asset_url('warbler.js'); the app serves
+/static/dist/ with the best encoding the browser accepts and a one-year
+immutable cache lifetime, since a changed file gets a new URL.
+
+Without a build, asset_url falls back to the plain /static/ URL.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import request, send_from_directory, abort
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+# Assets worth compressing; images are already compressed
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+
+# Precompressed variants, best first: (Accept-Encoding token, suffix)
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# url("/static/...") references inside CSS, rewritten to hashed URLs
+CSS_URL = re.compile(r'''url\(\s*(['"]?)/static/([^'")]+)\1\s*\)''')
+
+
+def fingerprint(path, contents):
+    """'images/logo.png' -> 'images/logo.<hash>.png'."""
+
+    digest = hashlib.sha256(contents).hexdigest()[:12]
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{digest}{ext}"
+
+
+def write_variants(out_path, contents):
+    """Write the asset plus its compressed variants if it's compressible."""
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    with open(out_path, 'wb') as f:
+        f.write(contents)
+
+    if os.path.splitext(out_path)[1] not in COMPRESSIBLE:
+        return
+
+    # mtime=0 keeps builds byte-for-byte reproducible
+    with open(out_path + '.gz', 'wb') as f:
+        f.write(gzip.compress(contents, compresslevel=9, mtime=0))
+
+    if brotli is not None:
+        with open(out_path + '.br', 'wb') as f:
+            f.write(brotli.compress(contents, quality=11))
+
+
+def source_assets(static_folder):
+    """Relative paths of every asset in `static_folder`, outside dist/."""
+
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if not (root == static_folder
+                                           and d == DIST_DIR)]
+        for name in files:
+            yield os.path.relpath(os.path.join(root, name), static_folder)
+
+
+def build(static_folder):
+    """Build static/dist/ from `static_folder`; returns the manifest."""
+
+    dist = os.path.join(static_folder, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    # CSS goes last so the URLs it references are already hashed
+    paths = sorted(source_assets(static_folder),
+                   key=lambda path: (path.endswith('.css'), path))
+    manifest = {}
+
+    for path in paths:
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            contents = f.read()
+
+        if path.endswith('.css'):
+            contents = CSS_URL.sub(
+                lambda m: f'url({m.group(1)}{asset_path(manifest, m.group(2))}'
+                          f'{m.group(1)})',
+                contents.decode('utf-8')).encode('utf-8')
+
+        hashed = fingerprint(path, contents).replace(os.sep, '/')
+        manifest[path.replace(os.sep, '/')] = hashed
+        write_variants(os.path.join(dist, hashed), contents)
+
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def asset_path(manifest, path):
+    """URL for static asset `path`, hashed if it's in `manifest`."""
+
+    if path in manifest:
+        return f"/static/{DIST_DIR}/{manifest[path]}"
+    return f"/static/{path}"
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def init_assets(app):
+    """Add asset_url() to templates and serve /static/dist/ precompressed."""
+
+    dist = os.path.join(app.static_folder, DIST_DIR)
+    manifest = load_manifest(app.static_folder)
+
+    app.jinja_env.globals['asset_url'] = lambda path: asset_path(manifest, path)
+
+    @app.route(f'/static/{DIST_DIR}/<path:filename>')
+    def dist_asset(filename):
+        """A fingerprinted asset, precompressed if the browser accepts it."""
+
+        if filename == MANIFEST:
+            abort(404)
+
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+        for encoding, suffix in ENCODINGS:
+            if (encoding in request.accept_encodings
+                    and os.path.isfile(os.path.join(dist, filename + suffix))):
+                response = send_from_directory(dist, filename + suffix,
+                                               mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(dist, filename, mimetype=mimetype)
+
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+
+if __name__ == '__main__':
+    static = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    manifest = build(static)
+    print(f"Built {len(manifest)} assets into {os.path.join(static, DIST_DIR)}")
@@ -0,0 +1,201 @@
+"""Lazy, cached loading of the logged-in user for Warbler.
+
+g.user is a CurrentUser: it knows the user's id from the session, answers
+the profile fields the layout needs (username, image_url, ...) from a
+short-lived cache, and only loads the User row when something else is
+asked of it.
+"""
+
+import time
+from datetime import datetime
+from threading import Lock
+
+from itsdangerous import BadSignature
+from werkzeug.http import dump_cookie
+
+from models import User
+
+# Session key holding the logged-in user's id
+CURR_USER_KEY = "curr_user"
+
+# User attributes kept in the profile cache
+PROFILE_FIELDS = (
+    'id', 'username', 'email', 'image_url', 'header_image_url', 'bio',
+    'location',
+)
+
+
+class ProfileCache:
+    """In-process cache of users' profile fields with a time-to-live.
+
+    Each worker process has its own cache, so an edit made through another
+    worker can be seen stale for up to `ttl` seconds.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, user_id):
+        """Cached fields for `user_id` as a dict, or None if missing/expired."""
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+
+            if entry is None:
+                return None
+
+            expires, fields = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+
+            return fields
+
+    def set(self, user, ttl=None):
+        """Cache the profile fields of `user`."""
+
+        fields = {name: getattr(user, name) for name in PROFILE_FIELDS}
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._entries[user.id] = (expires, fields)
+
+    def invalidate(self, user_id):
+        """Drop `user_id`; call after changing or deleting the user."""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+profile_cache = ProfileCache()
+
+
+def load_session(app, cookie):
+    """The contents of a session cookie of `app`, or {} if it's not valid.
+
+    For code running outside of Flask's request handling, which can't use
+    `session`.
+    """
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    if not cookie or serializer is None:
+        return {}
+
+    max_age = int(app.permanent_session_lifetime.total_seconds())
+    try:
+        return serializer.loads(cookie, max_age=max_age)
+    except BadSignature:
+        return {}
+
+
+def session_user_id(app, cookie):
+    """The logged-in user's id in a session cookie of `app`, or None."""
+
+    return load_session(app, cookie).get(CURR_USER_KEY)
+
+
+def session_cookie(app, data):
+    """A Set-Cookie header value saving `data` as `app`'s session."""
+
+    interface = app.session_interface
+    expires = None
+    if data.get('_permanent'):
+        expires = datetime.utcnow() + app.permanent_session_lifetime
+
+    return dump_cookie(
+        app.session_cookie_name,
+        interface.get_signing_serializer(app).dumps(dict(data)),
+        expires=expires,
+        domain=interface.get_cookie_domain(app),
+        path=interface.get_cookie_path(app),
+        secure=interface.get_cookie_secure(app),
+        httponly=interface.get_cookie_httponly(app),
+        samesite=interface.get_cookie_samesite(app))
+
+
+class CurrentUser:
+    """Stand-in for the logged-in User that loads it on demand.
+
+    Truthiness and profile fields come from the cache when possible; any
+    other attribute (relationships, counters, methods) loads the real User
+    once for this request and delegates to it.
+    """
+
+    def __init__(self, user_id, ttl=None):
+        self._user_id = user_id
+        self._ttl = ttl
+        self._user = None
+        self._loaded = False
+
+    def _get_current_object(self):
+        """The User row (or None if it no longer exists), loaded once."""
+
+        if not self._loaded:
+            self._user = User.query.get(self._user_id)
+            self._loaded = True
+
+            if self._user is not None:
+                profile_cache.set(self._user, self._ttl)
+
+        return self._user
+
+    def _profile(self):
+        """Profile fields as a dict, or None if the user doesn't exist."""
+
+        if self._loaded:
+            user = self._user
+        else:
+            fields = profile_cache.get(self._user_id)
+            if fields is not None:
+                return fields
+
+            user = self._get_current_object()
+
+        if user is None:
+            return None
+
+        return {name: getattr(user, name) for name in PROFILE_FIELDS}
+
+    @property
+    def id(self):
+        return self._user_id
+
+    def __bool__(self):
+        if self._loaded:
+            return self._user is not None
+        return self._profile() is not None
+
+    def __getattr__(self, name):
+        if name in PROFILE_FIELDS and not self._loaded:
+            fields = self._profile()
+            if fields is not None:
+                return fields[name]
+
+        return getattr(self._get_current_object(), name)
+
+    # User methods that only need the id run without loading the row
+
+    def is_following(self, other_user):
+        return User.is_following(self, other_user)
+
+    def following_ids(self, among=None):
+        return User.following_ids(self, among)
+
+    def liked_ids(self, among):
+        return User.liked_ids(self, among)
+
+    def __eq__(self, other):
+        other_id = getattr(other, 'id', None)
+        return bool(self) and other_id == self._user_id
+
+    def __hash__(self):
+        return hash(self._user_id)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._user_id}>"
@@ -0,0 +1,99 @@
+"""Cached HTML for message list items.
+
+A message's text, timestamp and author never change after posting, and
+the author's name and picture only change when they edit their profile,
+so the <li> for a message is rendered once per (message id, author
+profile_version) and reused for every viewer. Only the like star depends on who's looking;
+it's spliced into the cached HTML per request.
+
+Templates render list items with message_item(msg, liked_ids).
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from flask import g
+from markupsafe import Markup
+
+TEMPLATE = 'messages/_message.html'
+
+# Stands in for the like star in cached HTML
+STAR_MARKER = '<!--star-->'
+
+STAR = ('<form action="/messages/{id}/like" method="post" class="star">'
+        '<button><i class="{style} fa-star" id="{id}"></i></button></form>')
+
+
+class FragmentCache:
+    """In-process LRU cache of rendered fragments, at most `max_entries`."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is not None:
+                self._entries.move_to_end(key)
+            return fragment
+
+    def set(self, key, fragment):
+        with self._lock:
+            self._entries[key] = fragment
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def evict_message(self, message_id):
+        """Drop every cached version of message `message_id`."""
+
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == message_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+fragment_cache = FragmentCache()
+
+
+def init_fragments(app):
+    """Add message_item() to templates."""
+
+    fragment_cache.max_entries = app.config.get('FRAGMENT_CACHE_SIZE',
+                                                fragment_cache.max_entries)
+
+    def render_fragment(msg):
+        """(before, after) halves of `msg`'s cached HTML around the star."""
+
+        key = (msg.id, msg.user.profile_version)
+        fragment = fragment_cache.get(key)
+
+        if fragment is None:
+            html = app.jinja_env.get_template(TEMPLATE).render(
+                msg=msg, star=Markup(STAR_MARKER))
+            fragment = tuple(html.split(STAR_MARKER, 1))
+            fragment_cache.set(key, fragment)
+
+        return fragment
+
+    def message_item(msg, liked_ids=(), own_star=False):
+        """The <li> for `msg`, with the star as the current viewer sees it.
+
+        Viewers get no star on their own messages unless `own_star`.
+        """
+
+        before, after = render_fragment(msg)
+        viewer = g.user
+
+        if viewer and (own_star or msg.user_id != viewer.id):
+            style = 'fas' if msg.id in liked_ids else 'far'
+            return Markup(before + STAR.format(id=msg.id, style=style) + after)
+
+        return Markup(before + after)
+
+    app.jinja_env.globals['message_item'] = message_item
@@ -2,76 +2,164 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows:
+
+    python generator/create_csvs.py --users 100000 --messages 10000000 \\
+        --follows 5000000 --likes 20000000 --out /tmp/warbler-data
+    python seed.py --data /tmp/warbler-data
+
+The same arguments and --seed always produce the same files. Nothing is
+fetched from the network, and rows are written as they're generated, so
+memory use doesn't grow with the row counts. Who posts, who follows, who
+gets followed, who likes and what gets liked all follow power laws (see
+--skew). Every user's password is "password".
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+from datetime import datetime
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from faker.providers.lorem.en_US import Provider as LoremProvider
+
+from helpers import (HEADER_IMAGE_URLS, PowerLaw, degrees,
+                     get_random_datetime)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# bcrypt hash of "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+# Names, cities and domains are drawn from pools of this many Faker values
+POOL_SIZE = 1000
 
-# Generate random profile image URLs to use for users
-
-image_urls = [
+# Random profile image URLs to use for users
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
-
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+WORDS = list(LoremProvider.word_list)
+
+
+def sentence(rng, min_words=4, max_words=12):
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return ' '.join(words).capitalize() + '.'
+
+
+def write_users(path, args, rng):
+    fake = Faker()
+    fake.seed_instance(args.seed)
+
+    names = [fake.user_name() for _ in range(POOL_SIZE)]
+    domains = [fake.free_email_domain() for _ in range(10)]
+    cities = [fake.city() for _ in range(POOL_SIZE)]
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.writer(users_csv)
+        users_writer.writerow(USERS_CSV_HEADERS)
+
+        for id in range(1, args.users + 1):
+            # the id suffix keeps usernames and emails unique
+            username = f"{rng.choice(names)}{id}"
+            users_writer.writerow([
+                f"{username}@{rng.choice(domains)}",
+                username,
+                rng.choice(IMAGE_URLS),
+                PASSWORD_HASH,
+                sentence(rng),
+                rng.choice(HEADER_IMAGE_URLS),
+                rng.choice(cities),
+            ])
+
+
+def write_messages(path, args, rng):
+    posters = PowerLaw(args.users, args.skew, salt=1)
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.writer(messages_csv)
+        messages_writer.writerow(MESSAGES_CSV_HEADERS)
+
+        for i in range(args.messages):
+            text = ' '.join(sentence(rng) for _ in range(rng.randint(1, 3)))
+            messages_writer.writerow([
+                text[:MAX_WARBLER_LENGTH],
+                get_random_datetime(rng, args.end),
+                posters.sample(rng),
+            ])
+
+
+def write_follows(path, args, rng):
+    followers = PowerLaw(args.users, args.skew, salt=2)
+    followed = PowerLaw(args.users, args.skew, salt=3)
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.writer(follows_csv)
+        follows_writer.writerow(FOLLOWS_CSV_HEADERS)
+
+        for rank, count in degrees(args.users, args.follows, args.skew,
+                                   args.users - 1, rng):
+            follower = followers.id_for_rank(rank)
+            for followed_user in sorted(followed.sample_distinct(
+                    rng, count, exclude=follower)):
+                follows_writer.writerow([followed_user, follower])
+
+
+def write_likes(path, args, rng):
+    likers = PowerLaw(args.users, args.skew, salt=4)
+    liked = PowerLaw(args.messages, args.skew, salt=5)
+
+    with open(path, 'w', newline='') as likes_csv:
+        likes_writer = csv.writer(likes_csv)
+        likes_writer.writerow(LIKES_CSV_HEADERS)
+
+        if not args.messages:
+            return
+
+        for rank, count in degrees(args.users, args.likes, args.skew,
+                                   args.messages, rng):
+            user_id = likers.id_for_rank(rank)
+            for message_id in sorted(liked.sample_distinct(rng, count)):
+                likes_writer.writerow([user_id, message_id])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate Warbler's seed CSVs.")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000)
+    parser.add_argument('--likes', type=int, default=2000)
+    parser.add_argument('--skew', type=float, default=0.9,
+                        help="power-law (Zipf) exponent; 0 is uniform")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime(2020, 1, 1),
+                        help="messages are dated up to two years before this")
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="directory to write the CSVs to")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    # each file gets its own random stream, so e.g. changing --likes
+    # doesn't change the messages
+    for name, write in [('users', write_users),
+                        ('messages', write_messages),
+                        ('follows', write_follows),
+                        ('likes', write_likes)]:
+        write(os.path.join(args.out, f"{name}.csv"), args,
+              Random(f"{args.seed}-{name}"))
+        print(f"wrote {name}.csv")
+
+
+if __name__ == '__main__':
+    main()
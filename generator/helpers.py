@@ -1,14 +1,122 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from datetime import timedelta
+from math import gcd
 
+# Header images the bundled users.csv was built with
+HEADER_IMAGE_URLS = [
+    f"https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_{key}_1280.jpg"
+    for key in """
+        mnh0n9pHJW1st5lhmo1 mnh0uemhCk1st5lhmo1 mnh121HEWa1st5lhmo1
+        mnh17lfd9R1st5lhmo1 mnh1d7s3UD1st5lhmo1 mnh1jdFvHR1st5lhmo1
+        mnh1uhYnog1st5lhmo1 mnh25vNOvI1st5lhmo1 mnh29fxz111st5lhmo1
+        mnh2m1hnS81st5lhmo1 mo1h6tGOZf1st5lhmo1 mo2wz2LTCs1st5lhmo1
+        mo2x3aAnRH1st5lhmo1 mo2x80NkDu1st5lhmo1 mo2x9xqeef1st5lhmo1
+        mo2xbk8JUK1st5lhmo1 mo2xdqmle51st5lhmo1 mo2xfarCvW1st5lhmo1
+        mo2xgqdEFn1st5lhmo1 mo2xijE2nr1st5lhmo1 mopq4kHmAg1st5lhmo1
+        mopq69jlcS1st5lhmo1 mopq8fyQwI1st5lhmo1 mopqamedKu1st5lhmo1
+        mopqc3ZZcz1st5lhmo1 mopqdfx05t1st5lhmo1 mopqfpSTPN1st5lhmo1
+        mopqhxFulr1st5lhmo1 mopqj9QUeq1st5lhmo1 mopqkkwK2M1st5lhmo1
+        mp6rzyNlAN1st5lhmo1 mp6s1hAudo1st5lhmo1 mp6s32zb6l1st5lhmo1
+        mp6s4dzqHA1st5lhmo1 mp6s661UgK1st5lhmo1 mp6s7lR1lS1st5lhmo1
+        mp6s995bvI1st5lhmo1 mp6sasSvPZ1st5lhmo1 mp6scv2xrZ1st5lhmo1
+        mpp6f50W261st5lhmo1 mpp6gwrYvm1st5lhmo1 mpp6l06zXi1st5lhmo1
+        mpp6poZxE51st5lhmo1 mpp6tjdFhf1st5lhmo1 mpp6w0dxAm1st5lhmo1
+    """.split()
+]
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+def get_random_datetime(rng, end, year_gap=2):
+    """Get a random datetime within the `year_gap` years before `end`."""
 
-    return datetime.fromtimestamp(random_timestamp)
+    span = timedelta(days=365 * year_gap).total_seconds()
+    return end - timedelta(seconds=rng.uniform(0, span))
+
+
+class PowerLaw:
+    """Ids 1..n where the id at popularity rank r is drawn with probability
+    proportional to r ** -exponent (a Zipf distribution).
+
+    Ranks are spread over the ids by a fixed stride picked from `salt`, so
+    different distributions over the same ids (say, who posts most and who
+    is followed most) don't favour the same users, and nothing is kept per
+    id.
+    """
+
+    def __init__(self, n, exponent, salt=0):
+        self.n = n
+        self.exponent = exponent
+
+        self.stride = (salt * 7919 + 104729) % n or 1
+        while gcd(self.stride, n) != 1:
+            self.stride += 1
+        self.offset = salt % n
+
+    def id_for_rank(self, rank):
+        return ((rank - 1) * self.stride + self.offset) % self.n + 1
+
+    def sample_rank(self, rng):
+        """A rank in 1..n, by inverting the continuous power law's CDF."""
+
+        u = rng.random()
+
+        if self.exponent == 1:
+            x = (self.n + 1) ** u
+        else:
+            a = 1 - self.exponent
+            x = (1 + u * ((self.n + 1) ** a - 1)) ** (1 / a)
+
+        return min(int(x), self.n)
+
+    def sample(self, rng):
+        return self.id_for_rank(self.sample_rank(rng))
+
+    def sample_distinct(self, rng, k, exclude=None):
+        """`k` distinct ids (never `exclude`), popular ones most likely.
+
+        Falls back to uniform picks once the popular ids are used up, so a
+        large `k` doesn't spin on rejections.
+        """
+
+        chosen = set()
+        attempts = 0
+
+        while len(chosen) < k:
+            attempts += 1
+            if attempts <= 4 * k + 100:
+                id = self.sample(rng)
+            else:
+                id = rng.randint(1, self.n)
+
+            if id != exclude:
+                chosen.add(id)
+
+        return chosen
+
+
+def degrees(n, total, exponent, cap, rng):
+    """Yield (rank, degree) for ranks 1..n, degrees following a power law.
+
+    Degrees sum to about `total`; none exceeds `cap`. Fractions are rounded
+    at random, so the total comes out right on average.
+    """
+
+    if total <= 0 or cap <= 0:
+        for rank in range(1, n + 1):
+            yield rank, 0
+        return
+
+    weights = lambda: (rank ** -exponent for rank in range(1, n + 1))
+
+    # find the scale whose capped degrees add up to `total`
+    scale = total / sum(weights())
+    for _ in range(20):
+        reached = sum(min(scale * weight, cap) for weight in weights())
+        if reached >= total * 0.999 or reached >= n * cap:
+            break
+        scale *= total / reached
+
+    for rank, weight in enumerate(weights(), 1):
+        degree = min(scale * weight, cap)
+        whole = int(degree)
+        yield rank, whole + (rng.random() < degree - whole)
@@ -0,0 +1,305 @@
+"""Resized profile images for Warbler.
+
+Profile and header images are often full-size photos on other sites.
+/images/<variant>?src=<url> fetches a source image once, resizes it to
+the variant the page needs (see VARIANTS), and serves WebP to
+browsers that accept it and JPEG otherwise. Sources and variants are kept
+in a size-bounded on-disk LRU cache. Sources under /static/ are read from
+the app's static folder instead of being fetched; without Pillow, they're
+served unchanged and other sources are 404s.
+
+Templates build these URLs with thumb(src, variant).
+"""
+
+import hashlib
+import http.client
+import ipaddress
+import os
+import socket
+import ssl
+import tempfile
+from collections import OrderedDict
+from io import BytesIO
+from threading import Lock
+from urllib.parse import urlencode, urljoin, urlparse
+
+from flask import request, abort, send_from_directory
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# variant name -> (width, height) of the cropped, resized image, about
+# twice the size it's shown at (see style.css) for high-density screens
+VARIANTS = {
+    'avatar': (144, 144),    # .timeline-image, .card-image, navbar
+    'profile': (400, 400),   # #profile-avatar
+    'card': (720, 260),      # .card-hero
+    'hero': (1600, 480),     # #warbler-hero
+}
+
+# Refuse source images bigger than this
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+
+FETCH_TIMEOUT = 5
+
+# Redirects followed when fetching a source, each one vetted again
+MAX_REDIRECTS = 3
+
+CACHE_CONTROL = 'public, max-age=2592000'
+
+
+class DiskLRUCache:
+    """Files on disk, evicted least-recently-used past `max_bytes`.
+
+    The recency order and sizes live in memory (rebuilt from file mtimes
+    on startup), so lookups never scan the directory.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+        found = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp'):
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_mtime, name, stat.st_size))
+
+        for mtime, name, size in sorted(found):
+            self._entries[name] = size
+            self._size += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Cached bytes for `key`, or None."""
+
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # evicted by another process sharing the directory
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return None
+
+    def put(self, key, data):
+        """Store `data` under `key`, evicting old entries to make room."""
+
+        tmp = self._path(f"{key}.{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._size += len(data)
+
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                old_key, size = self._entries.popitem(last=False)
+                self._size -= size
+                try:
+                    os.remove(self._path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    @property
+    def size(self):
+        return self._size
+
+
+def thumb(src, variant):
+    """URL of the `variant` size of image `src`."""
+
+    if not src:
+        return src
+    return f"/images/{variant}?{urlencode({'src': src})}"
+
+
+def public_address(host):
+    """One address `host` resolves to, if it resolves only to public ones,
+    else None. (No fetching from localhost or the private network on a
+    user's behalf.)"""
+
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(
+            host, None, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        return None
+
+    addresses = [address.split('%')[0] for address in sorted(addresses)]
+    if not addresses or not all(ipaddress.ip_address(address).is_global
+                                for address in addresses):
+        return None
+
+    return addresses[0]
+
+
+def fetch(src):
+    """GET `src`, following a few redirects, or None.
+
+    Each hop's host is resolved once and the connection made to the
+    address that was vetted, so neither a redirect nor a second DNS answer
+    can point the fetch at a private address.
+    """
+
+    for _ in range(MAX_REDIRECTS + 1):
+        url = urlparse(src)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            return None
+
+        address = public_address(url.hostname)
+        if address is None:
+            return None
+
+        if url.scheme == 'https':
+            conn = http.client.HTTPSConnection(
+                url.hostname, url.port, timeout=FETCH_TIMEOUT,
+                context=ssl.create_default_context())
+        else:
+            conn = http.client.HTTPConnection(url.hostname, url.port,
+                                              timeout=FETCH_TIMEOUT)
+
+        # connect to the vetted address; Host, SNI and the certificate
+        # check still use the hostname
+        conn._create_connection = (
+            lambda target, *args: socket.create_connection(
+                (address, target[1]), *args))
+
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+
+        try:
+            conn.request('GET', path)
+            resp = conn.getresponse()
+
+            if resp.status in (301, 302, 303, 307, 308):
+                location = resp.getheader('Location')
+                if not location:
+                    return None
+                src = urljoin(src, location)
+                continue
+
+            if resp.status != 200:
+                return None
+            return resp.read(MAX_SOURCE_BYTES + 1)
+
+        except (OSError, ValueError, http.client.HTTPException):
+            return None
+        finally:
+            conn.close()
+
+    return None
+
+
+def read_source(app, src):
+    """Bytes of source image `src`, or None if it can't be used."""
+
+    if src.startswith('/static/'):
+        static = os.path.realpath(app.static_folder)
+        path = os.path.realpath(os.path.join(static, src[len('/static/'):]))
+        if not path.startswith(static + os.sep) or not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read(MAX_SOURCE_BYTES + 1)
+
+    return fetch(src)
+
+
+def resize(data, size, fmt):
+    """Crop `data` to the aspect ratio of `size`, scale it, encode as `fmt`."""
+
+    image = Image.open(BytesIO(data))
+    image.draft('RGB', size)
+    image = image.convert('RGB')
+
+    width, height = size
+    scale = max(width / image.width, height / image.height)
+    crop_width, crop_height = width / scale, height / scale
+    left = (image.width - crop_width) / 2
+    top = (image.height - crop_height) / 2
+
+    image = image.resize(size, Image.LANCZOS,
+                         box=(left, top, left + crop_width, top + crop_height))
+
+    out = BytesIO()
+    image.save(out, fmt, quality=82)
+    return out.getvalue()
+
+
+def init_images(app):
+    """Add thumb() to templates and the /images/<variant> endpoint."""
+
+    cache = DiskLRUCache(
+        app.config.get('IMAGE_CACHE_DIR',
+                       os.path.join(tempfile.gettempdir(), 'warbler-images')),
+        app.config.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+    app.extensions['image_cache'] = cache
+    app.jinja_env.globals['thumb'] = thumb
+
+    @app.route('/images/<variant>')
+    def resized_image(variant):
+        """The `variant` size of the image at ?src=."""
+
+        src = request.args.get('src', '')
+
+        if variant not in VARIANTS or not src:
+            abort(404)
+
+        if Image is None:
+            # no Pillow: serve our own images unchanged rather than break
+            # the page, but never send the browser off to another site
+            if not src.startswith('/static/'):
+                abort(404)
+            return send_from_directory(app.static_folder,
+                                       src[len('/static/'):])
+
+        # only browsers naming WebP outright; `in` would also match */*
+        webp = any(accepted == 'image/webp' and quality > 0
+                   for accepted, quality in request.accept_mimetypes)
+        fmt, mimetype = ('WEBP', 'image/webp') if webp else ('JPEG', 'image/jpeg')
+
+        src_key = hashlib.sha256(src.encode()).hexdigest()
+        key = f"{src_key}-{variant}.{fmt.lower()}"
+
+        data = cache.get(key)
+
+        if data is None:
+            source = cache.get(f"{src_key}.src")
+
+            if source is None:
+                source = read_source(app, src)
+                if source is None or len(source) > MAX_SOURCE_BYTES:
+                    abort(404)
+                cache.put(f"{src_key}.src", source)
+
+            try:
+                data = resize(source, VARIANTS[variant], fmt)
+            except (OSError, ValueError, Image.DecompressionBombError):
+                abort(404)
+
+            cache.put(key, data)
+
+        response = app.response_class(data, mimetype=mimetype)
+        response.headers['Cache-Control'] = CACHE_CONTROL
+        response.headers['Vary'] = 'Accept'
+        response.set_etag(key)
+        return response.make_conditional(request)
@@ -0,0 +1,134 @@
+"""Per-request SQL instrumentation for Warbler.
+
+When SQL_INSTRUMENTATION is on, every statement run while handling a
+request is counted and timed. The totals are sent back in a Server-Timing
+header and logged as one JSON line per request.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryStats:
+    """Statement count and timings collected for one request (or capture)."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+        self.statements = []
+
+    def record(self, statement, elapsed, parameters=None):
+        """Add one executed statement that took `elapsed` seconds."""
+
+        self.count += 1
+        self.total += elapsed
+        self.statements.append((statement, parameters))
+
+        if elapsed >= self.slowest:
+            self.slowest = elapsed
+            self.slowest_statement = statement
+
+    def server_timing(self):
+        """Format as a Server-Timing header value (durations in ms)."""
+
+        return (f'db;dur={self.total * 1000:.2f};desc="{self.count} queries", '
+                f'db-slowest;dur={self.slowest * 1000:.2f}')
+
+    def as_dict(self):
+        return {
+            'queries': self.count,
+            'db_ms': round(self.total * 1000, 2),
+            'slowest_ms': round(self.slowest * 1000, 2),
+            'slowest_statement': self.slowest_statement,
+        }
+
+
+# stats objects fed by every statement, whether or not we're in a request;
+# see capture_queries
+_captures = []
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+
+    for stats in _captures:
+        stats.record(statement, elapsed, parameters)
+
+    if has_request_context() and 'query_stats' in g:
+        g.query_stats.record(statement, elapsed)
+
+
+def start_request():
+    """Begin collecting stats for this request if instrumentation is on."""
+
+    if current_app.config.get('SQL_INSTRUMENTATION'):
+        g.query_stats = QueryStats()
+
+
+def finish_request(response):
+    """Attach this request's stats to the response and log them."""
+
+    stats = g.pop('query_stats', None)
+
+    if stats is not None:
+        response.headers.add('Server-Timing', stats.server_timing())
+
+        log_request(current_app.logger, stats,
+                    method=request.method,
+                    path=request.path,
+                    endpoint=request.endpoint,
+                    status=response.status_code)
+
+    return response
+
+
+def log_request(logger, stats, **request):
+    """Log one request's `stats` as a JSON line, with its method, path,
+    endpoint and status."""
+
+    logger.info(json.dumps(dict(stats.as_dict(), **request)))
+
+
+@contextmanager
+def capture_queries():
+    """Collect stats for every statement run inside the `with` block.
+
+    Works with or without instrumentation switched on, so tests can assert
+    query budgets:
+
+        with capture_queries() as stats:
+            client.get('/')
+        assert stats.count <= 6
+    """
+
+    stats = QueryStats()
+    _captures.append(stats)
+    try:
+        yield stats
+    finally:
+        _captures.remove(stats)
+
+
+def init_instrumentation(app):
+    """Hook SQL timing into the engine and request cycle of `app`."""
+
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -0,0 +1,197 @@
+"""Write-behind buffering of likes for Warbler.
+
+With LIKE_WRITE_BEHIND on, a star click doesn't write to `likes` itself.
+It records the state the user wants for that message, replacing any
+earlier one, so a run of toggles ends up as at most one change. A
+background thread writes what's pending in a single transaction every
+LIKE_FLUSH_INTERVAL seconds, or sooner once LIKE_FLUSH_SIZE likes are
+waiting.
+
+Until then, the liker's own pages overlay their pending likes: stars,
+their like count and page ETags. The buffer belongs to one worker
+process, so a request served by another worker can show the old state
+until the flush. Likes not yet written are lost if the process dies.
+"""
+
+import atexit
+import threading
+from collections import defaultdict
+
+from models import db, Like, User, insert_ignore, delete_row
+
+
+class LikeBuffer:
+    """Pending like states per (user, message), written in batches."""
+
+    def __init__(self, interval=0.5, max_pending=500):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.app = None
+
+        # (user_id, message_id) -> [liked in the database, liked wanted]
+        self._pending = {}
+        # the same for what's being written right now
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        """Read the flush interval and size from `app`'s config."""
+
+        self.app = app
+        self.interval = app.config.get('LIKE_FLUSH_INTERVAL', self.interval)
+        self.max_pending = app.config.get('LIKE_FLUSH_SIZE', self.max_pending)
+
+    def _current(self, key):
+        """The wanted state of a buffered like, or None. Hold the lock."""
+
+        entry = self._pending.get(key) or self._flushing.get(key)
+        return entry and entry[1]
+
+    def set(self, user_id, message_id, liked=None):
+        """Buffer `user_id`'s like of `message_id`; None toggles it.
+
+        Returns (liked, changed): the state now, and whether this changed
+        it.
+        """
+
+        key = (user_id, message_id)
+
+        with self._lock:
+            stored = self._current(key)
+        if stored is None:
+            stored = Like.exists(user_id, message_id)
+
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                current = self._current(key)
+                state = stored if current is None else current
+                entry = self._pending[key] = [state, state]
+
+            before = entry[1]
+            entry[1] = (not before) if liked is None else bool(liked)
+            full = len(self._pending) >= self.max_pending
+
+        self._start()
+        if full:
+            self._wake.set()
+
+        return entry[1], entry[1] != before
+
+    def pending(self, user_id):
+        """(message_id, liked) of `user_id`'s unwritten likes, sorted."""
+
+        with self._lock:
+            entries = {**self._flushing, **self._pending}
+
+        return sorted((message_id, wanted)
+                      for (liker, message_id), (_, wanted) in entries.items()
+                      if liker == user_id)
+
+    def overlay(self, user_id, liked_ids, among):
+        """`liked_ids` from the database, with `user_id`'s pending likes of
+        messages in `among` applied."""
+
+        among = set(among)
+        liked_ids = set(liked_ids)
+
+        for message_id, wanted in self.pending(user_id):
+            if message_id in among:
+                if wanted:
+                    liked_ids.add(message_id)
+                else:
+                    liked_ids.discard(message_id)
+
+        return liked_ids
+
+    def count_delta(self, user_id):
+        """How much `user_id`'s pending likes will change their like count."""
+
+        with self._lock:
+            entries = list(self._flushing.items()) + list(self._pending.items())
+
+        return sum(wanted - stored
+                   for (liker, _), (stored, wanted) in entries
+                   if liker == user_id)
+
+    def flush(self):
+        """Write every pending like in one transaction."""
+
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._pending = self._pending, {}
+
+            changes = [(key, wanted)
+                       for key, (stored, wanted) in self._flushing.items()
+                       if stored != wanted]
+            try:
+                if changes:
+                    self._write(changes)
+            except Exception:
+                db.session.rollback()
+                # a message or user deleted meanwhile fails the batch;
+                # write the rest one at a time
+                for change in changes:
+                    try:
+                        self._write([change])
+                    except Exception:
+                        db.session.rollback()
+                        self.app.logger.exception(
+                            "dropping buffered like %r", change)
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def _write(self, changes):
+        """Apply (key, liked) changes, adjusting counters once per user."""
+
+        deltas = defaultdict(int)
+
+        for (user_id, message_id), liked in changes:
+            if liked:
+                changed = insert_ignore(Like.__table__, user_id=user_id,
+                                        message_id=message_id)
+            else:
+                changed = delete_row(Like.__table__, user_id=user_id,
+                                     message_id=message_id)
+            if changed:
+                deltas[user_id] += 1 if liked else -1
+
+        for user_id, delta in deltas.items():
+            if delta:
+                User.adjust_counts(user_id, likes_count=delta)
+
+        db.session.commit()
+
+    def _start(self):
+        """Start the flushing thread if it isn't running."""
+
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='like-flush',
+                                                daemon=True)
+                self._thread.start()
+                atexit.register(self._flush_in_app)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._flush_in_app()
+
+    def _flush_in_app(self):
+        with self.app.app_context():
+            try:
+                self.flush()
+            finally:
+                db.session.remove()
+
+
+like_buffer = LikeBuffer()
@@ -0,0 +1,397 @@
+"""Load-test Warbler with a weighted mix of logged-in user actions.
+
+    python loadtest/driver.py --start-server --sessions 50 --duration 60 \\
+        --out results.json
+    python loadtest/driver.py --compare before.json results.json
+
+Each session logs in as one of the users in users.csv (as generated by
+generator/create_csvs.py, password "password") and repeats actions picked
+by weight: reading the timeline, viewing profiles, liking, following,
+posting, sending what warbler.js sends for each.
+Latencies are recorded per route. The report is JSON with p50/p95/p99
+(ms) and requests/second for each route, and --compare prints the change
+between two reports.
+
+With --start-server, gunicorn is started on --url's port against the
+DATABASE_URL in the environment and stopped afterwards. Seed that
+database from the same users.csv first.
+"""
+
+import argparse
+import csv
+import http.client
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlencode, urlsplit
+
+# action -> relative weight
+MIX = {
+    'timeline': 40,
+    'profile': 20,
+    'like': 15,
+    'follow': 8,
+    'post': 5,
+    'followers': 5,
+    'search': 7,
+}
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+STAR = re.compile(r'class="fa[rs] fa-star" id="(\d+)"')
+USER_LINK = re.compile(r'href="/users/(\d+)"')
+
+SEARCH_TERMS = ['hello', 'music', 'dog', 'city', 'think', 'nation', 'art']
+
+
+class Session:
+    """One user's cookie-keeping HTTP connection that records latencies."""
+
+    def __init__(self, url, recorder):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname,
+                                                     parts.port or 80,
+                                                     timeout=30)
+        self.cookies = {}
+        self.recorder = recorder
+
+    def request(self, route, method, path, form=None, json_body=None):
+        """Make one request; returns (status, body text)."""
+
+        headers = {'Accept-Encoding': 'identity'}
+        body = None
+
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif json_body is not None:
+            body = json.dumps(json_body)
+            headers['Content-Type'] = 'application/json'
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f"{name}={value}" for name, value
+                                          in self.cookies.items())
+
+        started = time.perf_counter()
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.recorder.record(route, time.perf_counter() - started, None)
+            return None, ''
+
+        self.recorder.record(route, time.perf_counter() - started,
+                             response.status)
+
+        for header in response.msg.get_all('Set-Cookie') or []:
+            name, _, value = header.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value
+
+        return response.status, data.decode('utf-8', 'replace')
+
+    def get(self, route, path):
+        return self.request(route, 'GET', path)
+
+    def post(self, route, path, form=None, json_body=None):
+        if json_body is None:
+            form = form or {}
+        return self.request(route, 'POST', path, form, json_body)
+
+
+class Recorder:
+    """Latencies (seconds) and failures per route, shared by all sessions."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.recording = False
+        self.lock = threading.Lock()
+
+    def record(self, route, elapsed, status):
+        if not self.recording:
+            return
+
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            if status is None or status >= 400:
+                self.errors[route] += 1
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, errors, seconds):
+    """The JSON report: per route and overall latency percentiles and rates."""
+
+    def stats(values, failed):
+        ordered = sorted(values)
+        return dict(
+            requests=len(ordered),
+            errors=failed,
+            rps=round(len(ordered) / seconds, 2),
+            p50=round(percentile(ordered, 0.50) * 1000, 2) if ordered else None,
+            p95=round(percentile(ordered, 0.95) * 1000, 2) if ordered else None,
+            p99=round(percentile(ordered, 0.99) * 1000, 2) if ordered else None,
+        )
+
+    routes = {route: stats(values, errors.get(route, 0))
+              for route, values in sorted(latencies.items())}
+    everything = [value for values in latencies.values() for value in values]
+
+    return dict(seconds=round(seconds, 2),
+                total=stats(everything, sum(errors.values())),
+                routes=routes)
+
+
+def compare(before, after):
+    """Lines describing how each route changed between two reports."""
+
+    lines = [f"{'route':<24}{'metric':>8}{'before':>12}{'after':>12}{'change':>10}"]
+
+    routes = [('total', before['total'], after['total'])]
+    routes += [(route, before['routes'].get(route), stats)
+               for route, stats in sorted(after['routes'].items())]
+
+    for route, old, new in routes:
+        if not old:
+            continue
+        for metric in ('p50', 'p95', 'p99', 'rps'):
+            if old[metric] is None or new[metric] is None:
+                continue
+            change = ((new[metric] - old[metric]) / old[metric] * 100
+                      if old[metric] else 0)
+            lines.append(f"{route:<24}{metric:>8}{old[metric]:>12}"
+                         f"{new[metric]:>12}{change:>+9.1f}%")
+
+    return lines
+
+
+def load_users(path, count):
+    """(id, username) of the first `count` users in a generated users.csv."""
+
+    users = []
+    with open(path, newline='') as f:
+        for id, row in enumerate(csv.DictReader(f), 1):
+            users.append((id, row['username']))
+            if len(users) == count:
+                break
+    return users
+
+
+def count_users(path):
+    with open(path) as f:
+        return sum(1 for _ in f) - 1
+
+
+class VirtualUser:
+    """A logged-in user repeating weighted actions until told to stop."""
+
+    def __init__(self, url, recorder, user, num_users, rng):
+        self.session = Session(url, recorder)
+        self.user_id, self.username = user
+        self.num_users = num_users
+        self.rng = rng
+        self.seen_messages = []
+        self.seen_users = []
+        self.liked = set()
+        self.csrf_token = None
+
+    def login(self):
+        _, html = self.session.get('login_form', '/login')
+        self.csrf_token = self.find_csrf(html)
+        status, _ = self.session.post('login', '/login', dict(
+            username=self.username, password='password',
+            csrf_token=self.csrf_token))
+        return status == 302
+
+    @staticmethod
+    def find_csrf(html):
+        match = CSRF_TOKEN.search(html)
+        return match and match.group(1)
+
+    def remember(self, html):
+        """Keep messages and users a page showed, as targets for actions."""
+
+        self.seen_messages = STAR.findall(html)[:50] or self.seen_messages
+        self.seen_users = USER_LINK.findall(html)[:50] or self.seen_users
+
+    def some_user(self):
+        if self.seen_users and self.rng.random() < 0.7:
+            return self.rng.choice(self.seen_users)
+        return self.rng.randint(1, self.num_users)
+
+    def timeline(self):
+        _, html = self.session.get('timeline', '/')
+        self.remember(html)
+
+    def profile(self):
+        _, html = self.session.get('profile', f'/users/{self.some_user()}')
+        self.remember(html)
+
+    def followers(self):
+        self.session.get('followers', f'/users/{self.some_user()}/followers')
+
+    def search(self):
+        term = self.rng.choice(SEARCH_TERMS)
+        self.session.get('search_messages', f'/messages/search?q={term}')
+
+    def like(self):
+        if not self.seen_messages:
+            return self.timeline()
+
+        message_id = self.rng.choice(self.seen_messages)
+        liked = message_id not in self.liked
+        self.liked ^= {message_id}
+        self.session.post('like', f'/messages/{message_id}/like',
+                          json_body=dict(liked=liked))
+
+    def follow(self):
+        other = self.some_user()
+        action = 'follow' if self.rng.random() < 0.7 else 'stop-following'
+        self.session.post(action.replace('-', '_'),
+                          f'/users/{action}/{other}')
+
+    def post(self):
+        words = ' '.join(self.rng.choice(SEARCH_TERMS) for _ in range(8))
+        self.session.post('post', '/messages/new',
+                          dict(text=words, csrf_token=self.csrf_token))
+
+    def run(self, actions, weights, stop):
+        while not stop.is_set():
+            getattr(self, self.rng.choices(actions, weights)[0])()
+
+
+def wait_for_server(url, timeout=30):
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port,
+                                                    timeout=2)
+            connection.request('GET', '/login')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+
+    raise RuntimeError(f"server at {url} didn't come up")
+
+
+def start_server(url, workers):
+    """Start gunicorn serving the app at `url`; returns the process."""
+
+    parts = urlsplit(url)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+         '--worker-class', 'gthread', '--threads', '8',
+         '--bind', f'{parts.hostname}:{parts.port}', 'app:app'],
+        cwd=root)
+
+    try:
+        wait_for_server(url)
+    except RuntimeError:
+        server.terminate()
+        raise
+
+    return server
+
+
+def run(args):
+    users = load_users(args.users_csv, args.sessions)
+    num_users = count_users(args.users_csv)
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+
+    virtual_users = [VirtualUser(args.url, recorder, user, num_users,
+                                 random.Random(rng.random()))
+                     for user in users]
+
+    failed = [vu.username for vu in virtual_users if not vu.login()]
+    if failed:
+        raise SystemExit(f"couldn't log in as {', '.join(failed[:5])}")
+
+    actions = list(MIX)
+    weights = [MIX[action] for action in actions]
+    stop = threading.Event()
+    threads = [threading.Thread(target=vu.run, args=(actions, weights, stop),
+                                daemon=True)
+               for vu in virtual_users]
+
+    for thread in threads:
+        thread.start()
+
+    time.sleep(args.warmup)
+    recorder.recording = True
+    started = time.monotonic()
+    time.sleep(args.duration)
+    recorder.recording = False
+    elapsed = time.monotonic() - started
+
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    return summarize(recorder.latencies, recorder.errors, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load-test Warbler with a weighted mix of user actions.")
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--users-csv', default='generator/users.csv')
+    parser.add_argument('--sessions', type=int, default=20,
+                        help="concurrent logged-in users")
+    parser.add_argument('--duration', type=float, default=30,
+                        help="seconds measured")
+    parser.add_argument('--warmup', type=float, default=5,
+                        help="seconds run before measuring")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start-server', action='store_true',
+                        help="run gunicorn for the duration of the test")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="gunicorn workers with --start-server")
+    parser.add_argument('--out', help="write the JSON report here")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="compare two reports instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path) as f:
+                reports.append(json.load(f))
+        print('\n'.join(compare(*reports)))
+        return
+
+    server = start_server(args.url, args.workers) if args.start_server else None
+    try:
+        report = run(args)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Replay traffic recorded by recorder.py against a Warbler instance.
+
+    TRAFFIC_LOG=traffic.jsonl gunicorn app:app      # record (production)
+    python loadtest/replay.py traffic.jsonl --speed 10 --out a.json
+    # ... switch builds ...
+    python loadtest/replay.py traffic.jsonl --speed 10 --out b.json
+    python loadtest/driver.py --compare a.json b.json
+
+Requests are sent in their recorded order and at their recorded pacing,
+sped up --speed times (0 sends them as fast as each user's requests
+allow). Each recorded user is logged in as a user of users.csv, in order
+of first appearance, so the same log always replays the same way; ids in
+paths are sent as recorded, so replay against a copy of the recorded
+database or one seeded from the same CSVs. Logins, signups, logouts and
+profile changes are skipped, and posts are sent with made-up text, as
+bodies aren't recorded.
+
+The report has the driver's format, with routes named by method and path
+with ids replaced, e.g. "GET /users/<id>".
+"""
+
+import argparse
+import json
+import queue
+import random
+import re
+import threading
+import time
+
+from driver import (Recorder, VirtualUser, count_users, load_users,
+                    start_server, summarize)
+
+# Requests not replayed: they'd log the replaying user out or change who
+# they are
+SKIPPED = {
+    ('POST', '/login'),
+    ('POST', '/signup'),
+    ('GET', '/logout'),
+    ('POST', '/users/profile'),
+    ('POST', '/users/delete'),
+}
+
+ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def route_key(method, path):
+    """Method and path with the query dropped and ids generalized."""
+
+    return f"{method} {ID_SEGMENT.sub('/<id>', path.split('?', 1)[0])}"
+
+
+def read_log(path, limit=None):
+    """Replayable entries of a traffic log, in the order they started.
+
+    (They're logged as they finish.)
+    """
+
+    with open(path) as f:
+        entries = [json.loads(line) for line in f]
+
+    entries = [entry for entry in entries
+               if (entry['method'], entry['path'].split('?', 1)[0])
+               not in SKIPPED]
+    entries.sort(key=lambda entry: entry['t'])
+    return entries[:limit]
+
+
+class Replayer(VirtualUser):
+    """A session sending one recorded user's requests in order."""
+
+    def __init__(self, url, recorder, user, num_users, rng):
+        super().__init__(url, recorder, user, num_users, rng)
+        self.queue = queue.Queue()
+
+    def send(self, entry):
+        route = route_key(entry['method'], entry['path'])
+
+        if entry['method'] == 'GET':
+            self.session.get(route, entry['path'])
+        elif route == 'POST /messages/new':
+            self.session.post(route, entry['path'], dict(
+                text=f"Replayed post {self.rng.randrange(10 ** 6)}",
+                csrf_token=self.csrf_token))
+        else:
+            self.session.post(route, entry['path'])
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            self.send(entry)
+
+
+def replay(args):
+    """Replay the log; returns the report."""
+
+    # one replayer per recorded user, plus logged-out sessions shared
+    # round-robin by anonymous requests
+    entries = read_log(args.log, args.limit)
+    recorded_users = []
+    for entry in entries:
+        if entry['user'] is not None and entry['user'] not in recorded_users:
+            recorded_users.append(entry['user'])
+
+    num_users = count_users(args.users_csv)
+    local_users = load_users(args.users_csv, len(recorded_users))
+    recorder = Recorder()
+
+    replayers = {}
+    for i, recorded in enumerate(recorded_users):
+        replayer = Replayer(args.url, recorder,
+                            local_users[i % len(local_users)], num_users,
+                            random.Random(f"{args.seed}-{i}"))
+        if not replayer.login():
+            raise SystemExit(f"couldn't log in as {replayer.username}")
+        replayers[recorded] = replayer
+
+    anonymous = [Replayer(args.url, recorder, (None, None), num_users,
+                          random.Random(f"{args.seed}-anonymous-{i}"))
+                 for i in range(args.anonymous_sessions)]
+
+    threads = [threading.Thread(target=replayer.run, daemon=True)
+               for replayer in [*replayers.values(), *anonymous]]
+    for thread in threads:
+        thread.start()
+
+    recorder.recording = True
+    started = time.monotonic()
+
+    for i, entry in enumerate(entries):
+        if args.speed:
+            due = started + (entry['t'] - entries[0]['t']) / args.speed
+            time.sleep(max(0, due - time.monotonic()))
+
+        if entry['user'] is None:
+            anonymous[i % len(anonymous)].queue.put(entry)
+        else:
+            replayers[entry['user']].queue.put(entry)
+
+    for replayer in [*replayers.values(), *anonymous]:
+        replayer.queue.put(None)
+    for thread in threads:
+        thread.join()
+
+    recorder.recording = False
+    return summarize(recorder.latencies, recorder.errors,
+                     time.monotonic() - started)
+
+
+def positive_int(value):
+    """argparse type for counts that must be at least 1."""
+
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded Warbler traffic log.")
+    parser.add_argument('log', help="JSONL file written by recorder.py")
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--users-csv', default='generator/users.csv',
+                        help="users recorded users are replayed as")
+    parser.add_argument('--speed', type=float, default=1,
+                        help="pacing multiplier; 0 for no pauses")
+    parser.add_argument('--limit', type=int,
+                        help="replay only the first LIMIT requests")
+    parser.add_argument('--anonymous-sessions', type=positive_int,
+                        default=4,
+                        help="logged-out sessions to spread anonymous "
+                             "requests over")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start-server', action='store_true',
+                        help="run gunicorn for the duration of the replay")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="gunicorn workers with --start-server")
+    parser.add_argument('--out', help="write the JSON report here")
+    args = parser.parse_args()
+
+    server = start_server(args.url, args.workers) if args.start_server else None
+    try:
+        report = replay(args)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Versioned, in-place schema migrations for Warbler.
+
+Each migration has a version number and is applied at most once; applied
+versions are recorded in the schema_migrations table. Run pending ones
+with:
+
+    flask migrate
+
+A database built from scratch with db.create_all() already has the
+latest schema, so seed.py stamps it with stamp() instead. On Postgres,
+indexes are built CONCURRENTLY so a live database keeps taking writes.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import (MetaData, Table, Column, Integer, Text, DateTime,
+                        inspect)
+
+from models import db, User, Timeline, TIMELINE_LENGTH
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def create_index(name, table, columns, using=None, concurrently=True):
+    """Create an index unless it exists, without blocking writes on Postgres.
+
+    Pass concurrently=False for a database nothing else is using yet (e.g.
+    while seeding); a plain build is quicker.
+    """
+
+    if is_postgres():
+        method = f" USING {using}" if using else ""
+        option = " CONCURRENTLY" if concurrently else ""
+        statement = (f"CREATE INDEX{option} IF NOT EXISTS {name} "
+                     f"ON {table}{method} ({columns})")
+
+        # CONCURRENTLY can't run inside a transaction
+        with db.engine.connect() as conn:
+            (conn.execution_options(isolation_level='AUTOCOMMIT')
+             .execute(statement))
+    else:
+        db.session.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+        db.session.commit()
+
+
+def counters_and_timelines():
+    """Add the user counter columns and the timelines table, then fill them."""
+
+    columns = {column['name'] for column in inspect(db.engine).get_columns('users')}
+
+    for name in ('messages_count', 'following_count', 'followers_count',
+                 'likes_count'):
+        if name not in columns:
+            db.session.execute(f"ALTER TABLE users ADD COLUMN {name} "
+                               f"INTEGER NOT NULL DEFAULT 0")
+
+    db.session.commit()
+
+    Timeline.__table__.create(db.engine, checkfirst=True)
+
+    User.recount()
+    db.session.commit()
+
+    # the rebuild reads each followed user's newest messages, which without
+    # these indexes is a scan of messages per follow (version 3 would
+    # build them too late)
+    index_pack(tables=('messages', 'follows', 'likes'))
+
+    # in batches of users, each capped like the app's own timelines
+    Timeline.rebuild(length=TIMELINE_LENGTH)
+
+
+def search_indexes(concurrently=True):
+    """Trigram, prefix and full-text indexes used by search.py (Postgres)."""
+
+    if not is_postgres():
+        return
+
+    db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    db.session.commit()
+
+    create_index('ix_users_username_trgm', 'users',
+                 'username gin_trgm_ops', using='gin',
+                 concurrently=concurrently)
+    create_index('ix_users_username_lower_prefix', 'users',
+                 'lower(username) text_pattern_ops',
+                 concurrently=concurrently)
+    create_index('ix_messages_text_fts', 'messages',
+                 "to_tsvector('english', text)", using='gin',
+                 concurrently=concurrently)
+
+
+# (name, table, columns) of the secondary indexes on the hot read paths
+INDEX_PACK = [
+    ('ix_messages_user_id_timestamp', 'messages', 'user_id, timestamp, id'),
+    ('ix_follows_user_following_id', 'follows',
+     'user_following_id, user_being_followed_id'),
+    ('ix_likes_message_id', 'likes', 'message_id, user_id'),
+    ('ix_timelines_user_id_timestamp', 'timelines',
+     'user_id, timestamp, message_id'),
+]
+
+
+def index_pack(concurrently=True, tables=None):
+    """Secondary indexes for the timeline, profile, follow and like paths.
+
+    With `tables`, only the indexes on those tables are built.
+    """
+
+    for name, table, columns in INDEX_PACK:
+        if tables is None or table in tables:
+            create_index(name, table, columns, concurrently=concurrently)
+
+
+def user_versions():
+    """Add users.version, the data version behind profile and message ETags."""
+
+    columns = {column['name'] for column in inspect(db.engine).get_columns('users')}
+
+    if 'version' not in columns:
+        db.session.execute("ALTER TABLE users ADD COLUMN version "
+                           "INTEGER NOT NULL DEFAULT 0")
+        db.session.commit()
+
+
+def profile_versions():
+    """Add users.profile_version, the key of cached message list items."""
+
+    columns = {column['name'] for column in inspect(db.engine).get_columns('users')}
+
+    if 'profile_version' not in columns:
+        db.session.execute("ALTER TABLE users ADD COLUMN profile_version "
+                           "INTEGER NOT NULL DEFAULT 0")
+        db.session.commit()
+
+
+# (version, migration) in the order they must run; never renumber
+MIGRATIONS = [
+    (1, counters_and_timelines),
+    (2, search_indexes),
+    (3, index_pack),
+    (4, user_versions),
+    (5, profile_versions),
+]
+
+
+def applied_versions():
+    """Versions already recorded in schema_migrations."""
+
+    schema_migrations.create(db.engine, checkfirst=True)
+
+    return {version for (version,) in
+            db.session.execute(schema_migrations.select()
+                               .with_only_columns([schema_migrations.c.version]))}
+
+
+def record(version, migration):
+    db.session.execute(schema_migrations.insert().values(
+        version=version,
+        name=migration.__name__,
+        applied_at=datetime.utcnow()))
+    db.session.commit()
+
+
+def apply_migrations():
+    """Run every pending migration in order; returns the versions applied."""
+
+    done = applied_versions()
+    applied = []
+
+    for version, migration in MIGRATIONS:
+        if version not in done:
+            migration()
+            record(version, migration)
+            applied.append(version)
+
+    return applied
+
+
+def stamp():
+    """Mark every migration as applied (for databases made by create_all)."""
+
+    done = applied_versions()
+
+    for version, migration in MIGRATIONS:
+        if version not in done:
+            record(version, migration)
@@ -2,11 +2,134 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import DDL, event, orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import SelectBase, UpdateBase
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import password_hasher
+
+
+class RoutingSession(SignallingSession):
+    """Session that can send reads to a read replica.
+
+    While info['replica'] names one of SQLALCHEMY_BINDS, queries run
+    there; inserts, updates, deletes and flushes still go to the primary.
+    The app sets it per request (see app.py).
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+
+        if (replica and not self._flushing
+                and not isinstance(clause, UpdateBase)):
+            return db.get_engine(self.app, bind=replica)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+# How many entries each materialized home timeline keeps: older ones are
+# trimmed when a follow backfills one, and by `flask trim-timelines`.
+TIMELINE_LENGTH = 800
+
+# Messages shown per page of a timeline or profile.
+PAGE_SIZE = 100
+
+
+def encode_cursor(timestamp, id):
+    """Build the opaque "load more" cursor pointing just past a message."""
+
+    return f"{timestamp.isoformat()}_{id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, id), or None if it's malformed."""
+
+    try:
+        timestamp, id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def insert_ignore(table, **values):
+    """Insert a row into `table` unless its key is already there.
+
+    Returns whether a row was inserted. It's one statement, so concurrent
+    inserts of the same row can't both succeed or fail on the duplicate.
+    """
+
+    statement = insert_ignore_statement(table, db.engine.dialect.name,
+                                        **values)
+
+    return db.session.execute(statement).rowcount == 1
+
+
+def insert_ignore_statement(table, dialect_name, **values):
+    """The statement insert_ignore runs on a `dialect_name` database."""
+
+    if dialect_name == 'postgresql':
+        return (postgresql.insert(table).values(**values)
+                .on_conflict_do_nothing())
+
+    return table.insert().values(**values).prefix_with('OR IGNORE')
+
+
+def delete_row(table, **values):
+    """Delete the row of `table` with these column values.
+
+    Returns whether there was one to delete.
+    """
+
+    return db.session.execute(delete_row_statement(table, **values)).rowcount == 1
+
+
+def execute_bulk(statement):
+    """Run a bulk UPDATE or DELETE, first flushing pending objects as
+    Query.update() and Query.delete() do."""
+
+    db.session.flush()
+    return db.session.execute(statement)
+
+
+def delete_row_statement(table, **values):
+    """The statement delete_row runs."""
+
+    criteria = [table.c[name] == value for name, value in values.items()]
+    return table.delete().where(db.and_(*criteria))
+
+
+def page_query(query, before=None, timestamp_col=None, id_col=None,
+               limit=PAGE_SIZE):
+    """`query` narrowed to one page, plus one row to tell if there's another.
+
+    Pages are keyed on (timestamp, id) rather than OFFSET, so every page is a
+    single index range scan no matter how deep it is. `before` is the cursor
+    from the previous page.
+    """
+
+    if timestamp_col is None:
+        timestamp_col = Message.timestamp
+    if id_col is None:
+        id_col = Message.id
+
+    position = decode_cursor(before) if before else None
+    if position:
+        timestamp, id = position
+        query = query.filter(db.or_(
+            timestamp_col < timestamp,
+            db.and_(timestamp_col == timestamp, id_col < id)))
+
+    return (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(limit + 1))
 
 
 class Follows(db.Model):
@@ -14,6 +137,13 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # the primary key leads with the followed user; this serves lookups
+    # of who a user follows
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -26,6 +156,55 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? One primary key lookup."""
+
+        row = (cls.query
+               .filter_by(user_being_followed_id=followed_id,
+                          user_following_id=follower_id))
+
+        return db.session.query(row.exists()).scalar()
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Have `follower_id` follow `followed_id`, if they don't already.
+
+        Counters and the follower's timeline are only updated when the
+        follow is new. Returns whether it was. Users can't follow
+        themselves (their own messages are in their timeline anyway).
+        """
+
+        if follower_id == followed_id:
+            raise ValueError("users can't follow themselves")
+
+        added = insert_ignore(cls.__table__,
+                              user_being_followed_id=followed_id,
+                              user_following_id=follower_id)
+        if added:
+            User.adjust_counts(follower_id, following_count=1)
+            User.adjust_counts(followed_id, followers_count=1)
+            Timeline.backfill(follower_id, followed_id)
+
+        return added
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Have `follower_id` stop following `followed_id`, if they do.
+
+        Returns whether they did.
+        """
+
+        removed = delete_row(cls.__table__,
+                             user_being_followed_id=followed_id,
+                             user_following_id=follower_id)
+        if removed:
+            User.adjust_counts(follower_id, following_count=-1)
+            User.adjust_counts(followed_id, followers_count=-1)
+            Timeline.prune(follower_id, followed_id)
+
+        return removed
+
 
 class User(db.Model):
     """User in the system."""
@@ -72,6 +251,57 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts for the profile header and the count endpoints.
+    # The write paths keep these in step through adjust_counts; recount()
+    # rebuilds them from the underlying tables.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever anything shown on this user's pages changes: profile
+    # edits, counters, and this user's own follows and likes (which change
+    # how other pages look to them). Used to build ETags.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped only by profile edits: the name and picture on cached message
+    # list items (see fragments.py) don't change with follows and likes.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message', cascade="all,delete", order_by='Message.timestamp.desc()')
 
     followers = db.relationship(
@@ -96,14 +326,110 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=self.id, followed_id=other_user.id)
+
+    def following_ids(self, among=None):
+        """Set of ids of the users this user follows.
+
+        Pages that list many users load this once and test membership with
+        `id in following_ids`, rather than calling is_following per row.
+        Pass `among` (ids on the page) to only fetch the ids that matter.
+        """
+
+        query = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == self.id))
+
+        if among is not None:
+            query = query.filter(Follows.user_being_followed_id.in_(among))
+
+        return {id for (id,) in query}
+
+    def liked_ids(self, among):
+        """Ids of the messages in `among` (a page of ids) this user liked.
+
+        Only the page being rendered is checked, so the cost doesn't grow
+        with how many messages the user has liked over time.
+        """
+
+        query = (db.session
+                 .query(Like.message_id)
+                 .filter(Like.user_id == self.id,
+                         Like.message_id.in_(among)))
+
+        return {id for (id,) in query}
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to counter columns, e.g. adjust_counts(1, likes_count=1).
+
+        `user_ids` is a single id or a select of ids, and a delta may be a
+        SQL expression, e.g. a count correlated with users.id. The update is
+        done in SQL (col = col + delta) so concurrent writers don't lose
+        increments.
+        The users' version is bumped along with their counters.
+        """
+
+        execute_bulk(cls.adjust_counts_statement(user_ids, **deltas))
+
+    @classmethod
+    def adjust_counts_statement(cls, user_ids, **deltas):
+        """The UPDATE adjust_counts runs."""
+
+        if isinstance(user_ids, SelectBase):
+            criterion = cls.id.in_(user_ids)
+        else:
+            criterion = cls.id == user_ids
+
+        values = {name: getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        values['version'] = cls.version + 1
+
+        return cls.__table__.update().where(criterion).values(values)
+
+    @classmethod
+    def recount(cls):
+        """Recompute every counter column from messages, follows and likes.
+
+        On Postgres each counter is one grouped count joined back to users,
+        which needs no indexes on the source tables (seed.py runs it before
+        building them).
+        """
+
+        sources = [
+            (cls.messages_count, Message.user_id),
+            (cls.following_count, Follows.user_following_id),
+            (cls.followers_count, Follows.user_being_followed_id),
+            (cls.likes_count, Like.user_id),
+        ]
+
+        if db.engine.dialect.name != 'postgresql':
+            def count(key):
+                return (db.select([db.func.count()])
+                        .select_from(key.class_.__table__)
+                        .where(key == cls.id)
+                        .as_scalar())
+
+            cls.query.update({counter: count(key) for counter, key in sources},
+                             synchronize_session=False)
+            return
+
+        cls.query.update({counter: 0 for counter, _ in sources},
+                         synchronize_session=False)
+
+        for counter, key in sources:
+            counts = (db.select([key.label('id'),
+                                 db.func.count().label('count')])
+                      .group_by(key)
+                      .alias('counts'))
+            db.session.execute(cls.__table__.update()
+                               .where(cls.id == counts.c.id)
+                               .values({counter.key: counts.c.count}))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -111,7 +437,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -134,19 +460,61 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's password?
+
+        If it does and the stored hash was made at a different bcrypt cost
+        than the configured one, the password is rehashed at the new cost;
+        the caller commits it along with the rest of the request.
+        """
+
+        if not password_hasher.check(self.password, password):
+            return False
+
+        if password_hasher.needs_rehash(self.password):
+            self.password = password_hasher.hash(password)
+
+        return True
+
+
+# Search indexes used by search.py. Postgres only: a trigram GIN index for
+# username substring matches, and a lower(username) pattern index for
+# typeahead.
+
+event.listen(
+    User.__table__, 'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    .execute_if(dialect='postgresql'))
+
+event.listen(
+    User.__table__, 'after_create',
+    DDL('CREATE INDEX ix_users_username_trgm '
+        'ON users USING gin (username gin_trgm_ops)')
+    .execute_if(dialect='postgresql'))
+
+event.listen(
+    User.__table__, 'after_create',
+    DDL('CREATE INDEX ix_users_username_lower_prefix '
+        'ON users (lower(username) text_pattern_ops)')
+    .execute_if(dialect='postgresql'))
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # profile pages: one user's messages, newest first, keyed by id
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 'user_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -160,7 +528,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -176,6 +544,12 @@ class Like(db.Model):
      
     __tablename__ = "likes"
 
+    # who liked a message (users_likes, deletes); the primary key leads
+    # with user_id
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id', 'user_id'),
+    )
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete='CASCADE'),
@@ -188,8 +562,305 @@ class Like(db.Model):
         nullable=False, primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, user_id, message_id):
+        """Has `user_id` liked `message_id`? One primary key lookup."""
+
+        row = cls.query.filter_by(user_id=user_id, message_id=message_id)
+
+        return db.session.query(row.exists()).scalar()
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Like a message unless already liked; returns whether it was new."""
+
+        added = insert_ignore(cls.__table__, user_id=user_id,
+                              message_id=message_id)
+        if added:
+            User.adjust_counts(user_id, likes_count=1)
+
+        return added
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Unlike a message if liked; returns whether it was."""
+
+        removed = delete_row(cls.__table__, user_id=user_id,
+                             message_id=message_id)
+        if removed:
+            User.adjust_counts(user_id, likes_count=-1)
+
+        return removed
+
 # CHECK THIS TABLE!!!!!!!! ^
 
+# Full-text search index for search.py (Postgres only). The expression must
+# match the one search.py queries with, or the planner won't use it.
+
+event.listen(
+    Message.__table__, 'after_create',
+    DDL("CREATE INDEX ix_messages_text_fts "
+        "ON messages USING gin (to_tsvector('english', text))")
+    .execute_if(dialect='postgresql'))
+
+
+class Timeline(db.Model):
+    """A message id materialized into a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write) and when a
+    user follows someone, so the homepage reads a pre-sorted list instead of
+    searching every followed user's messages.
+    """
+
+    __tablename__ = 'timelines'
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # copied from the message so the timeline can be sorted without a join
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @classmethod
+    def fan_out(cls, message):
+        """Push `message` into its author's and every follower's timeline.
+
+        Nothing is trimmed here: for a popular author that would touch every
+        follower's timeline on each post. trim_all catches up out of band.
+        """
+
+        db.session.add(cls(user_id=message.user_id,
+                           message_id=message.id,
+                           timestamp=message.timestamp))
+
+        # (a self-follow from before they were refused would be a duplicate)
+        followers = (db.select([Follows.user_following_id])
+                     .where(Follows.user_being_followed_id == message.user_id)
+                     .where(Follows.user_following_id != message.user_id))
+        entries = followers.with_only_columns([Follows.user_following_id,
+                                               db.literal(message.id),
+                                               db.literal(message.timestamp)])
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], entries))
+
+    @classmethod
+    def backfill(cls, user_id, followed_id, length=TIMELINE_LENGTH):
+        """Copy recent messages of `followed_id` into `user_id`'s timeline,
+        trimming it back to `length` entries."""
+
+        if user_id == followed_id:
+            return
+
+        for statement in cls.backfill_statements(user_id, followed_id, length):
+            db.session.execute(statement)
+
+    @classmethod
+    def backfill_statements(cls, user_id, followed_id, length=TIMELINE_LENGTH):
+        """The INSERT and trim backfill runs."""
+
+        recent = (db.select([db.cast(user_id, db.Integer),
+                             Message.id,
+                             Message.timestamp])
+                  .where(Message.user_id == followed_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(length))
+
+        return (cls.__table__.insert().from_select(
+                    ['user_id', 'message_id', 'timestamp'], recent),
+                cls.trim_statement(user_id, length))
+
+    @classmethod
+    def trim(cls, user_id, length=TIMELINE_LENGTH):
+        """Drop all but the newest `length` entries of `user_id`'s timeline."""
+
+        execute_bulk(cls.trim_statement(user_id, length))
+
+    @classmethod
+    def trim_statement(cls, user_id, length=TIMELINE_LENGTH):
+        """The DELETE trim runs.
+
+        The entries past the newest `length` are found by skipping that many
+        along ix_timelines_user_id_timestamp, so the cost is bounded by
+        `length` plus what's deleted, however long the timeline has grown.
+        """
+
+        old = (db.select([cls.message_id])
+               .where(cls.user_id == user_id)
+               .order_by(cls.timestamp.desc(), cls.message_id.desc())
+               .offset(length))
+
+        return (cls.__table__.delete()
+                .where(cls.user_id == user_id)
+                .where(cls.message_id.in_(old)))
+
+    @classmethod
+    def trim_all(cls, length=TIMELINE_LENGTH, batch_size=1000):
+        """Trim every timeline back to `length` entries.
+
+        Run periodically (`flask trim-timelines`) to undo the growth from
+        fan_out. Users are trimmed `batch_size` at a time, committing after
+        each batch.
+        """
+
+        last = 0
+
+        while True:
+            ids = [id for (id,) in (db.session.query(User.id)
+                                    .filter(User.id > last)
+                                    .order_by(User.id)
+                                    .limit(batch_size))]
+            if not ids:
+                break
+
+            for user_id in ids:
+                cls.trim(user_id, length)
+            db.session.commit()
+            last = ids[-1]
+
+    @classmethod
+    def prune(cls, user_id, followed_id):
+        """Remove messages of `followed_id` from `user_id`'s timeline."""
+
+        if user_id == followed_id:
+            # their own messages stay
+            return
+
+        execute_bulk(cls.prune_statement(user_id, followed_id))
+
+    @classmethod
+    def prune_statement(cls, user_id, followed_id):
+        """The DELETE prune runs."""
+
+        followed_messages = (db.select([Message.id])
+                             .where(Message.user_id == followed_id))
+
+        return (cls.__table__.delete()
+                .where(cls.user_id == user_id)
+                .where(cls.message_id.in_(followed_messages)))
+
+    @classmethod
+    def rebuild(cls, length=TIMELINE_LENGTH, batch_size=1000):
+        """Recompute every timeline from `messages` and `follows`.
+
+        Used after bulk loads (see seed.py) and migrations that bypass the
+        write paths. Each user keeps their newest `length` entries. Users
+        are rebuilt `batch_size` at a time, committing after each batch, so
+        a live database never holds one transaction over the whole table.
+        """
+
+        last = 0
+
+        while True:
+            ids = [id for (id,) in (db.session.query(User.id)
+                                    .filter(User.id > last)
+                                    .order_by(User.id)
+                                    .limit(batch_size))]
+            if not ids:
+                break
+
+            cls.rebuild_users(ids[0], ids[-1], length)
+            db.session.commit()
+            last = ids[-1]
+
+    @classmethod
+    def rebuild_users(cls, first_id, last_id, length=TIMELINE_LENGTH):
+        """Recompute the timelines of users `first_id` to `last_id`.
+
+        Only each author's newest `length` messages are candidates, so the
+        work is bounded by follows rather than by every message they cover.
+        """
+
+        (cls.query
+         .filter(cls.user_id.between(first_id, last_id))
+         .delete(synchronize_session=False))
+
+        # (timeline owner, author): each user and everyone they follow
+        sources = db.union_all(
+            db.select([User.id.label('user_id'),
+                       User.id.label('author_id')])
+            .where(User.id.between(first_id, last_id)),
+            db.select([Follows.user_following_id,
+                       Follows.user_being_followed_id])
+            .where(Follows.user_following_id.between(first_id, last_id))
+            .where(Follows.user_following_id
+                   != Follows.user_being_followed_id),
+        ).alias('sources')
+
+        if db.engine.dialect.name == 'postgresql':
+            # one index range scan per author
+            recent = (db.select([Message.id, Message.timestamp])
+                      .where(Message.user_id == sources.c.author_id)
+                      .order_by(Message.timestamp.desc(), Message.id.desc())
+                      .limit(length)
+                      .lateral('recent'))
+            entries = (db.select([sources.c.user_id,
+                                  recent.c.id.label('message_id'),
+                                  recent.c.timestamp])
+                       .select_from(sources.join(recent, db.true())))
+        else:
+            newest = Message.__table__.alias('newest')
+            recent = (db.select([newest.c.id])
+                      .where(newest.c.user_id == sources.c.author_id)
+                      .order_by(newest.c.timestamp.desc(), newest.c.id.desc())
+                      .limit(length))
+            entries = (db.select([sources.c.user_id,
+                                  Message.id.label('message_id'),
+                                  Message.timestamp])
+                       .where(Message.user_id == sources.c.author_id)
+                       .where(Message.id.in_(recent)))
+
+        entries = entries.alias('entries')
+        rank = (db.func.row_number()
+                .over(partition_by=entries.c.user_id,
+                      order_by=(entries.c.timestamp.desc(),
+                                entries.c.message_id.desc())))
+        ranked = db.select([entries, rank.label('rank')]).alias('ranked')
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'],
+            db.select([ranked.c.user_id,
+                       ranked.c.message_id,
+                       ranked.c.timestamp])
+            .where(ranked.c.rank <= length)))
+
+    @classmethod
+    def page_query(cls, user_id, before=None, limit=PAGE_SIZE, options=None):
+        """Query for one page of `user_id`'s timeline, newest first.
+
+        See page_query; `options` is an optional function applied to the
+        query, e.g. to eager load.
+        """
+
+        query = (Message
+                 .query
+                 .join(cls, cls.message_id == Message.id)
+                 .filter(cls.user_id == user_id))
+
+        if options:
+            query = options(query)
+
+        return page_query(query, before,
+                          timestamp_col=cls.timestamp,
+                          id_col=cls.message_id,
+                          limit=limit)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -197,4 +868,5 @@ def connect_db(app):
     """
 
     db.app = app
-    db.init_app(app)
\ No newline at end of file
+    db.init_app(app)
+    password_hasher.init_app(app)
\ No newline at end of file
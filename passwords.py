@@ -0,0 +1,87 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow, so hashing and checking run on a small,
+bounded thread pool instead of inline in the view. When more than
+PASSWORD_HASH_QUEUE operations are already in flight, or one takes longer
+than PASSWORD_HASH_TIMEOUT, the request fails fast with PasswordHasherBusy
+rather than queueing behind them and tying up every worker.
+
+The bound is per process and only matters when a process serves requests
+concurrently, so the Procfile runs gunicorn with threaded (gthread)
+workers: a login waiting on bcrypt holds one thread, not the whole worker.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import BoundedSemaphore
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already in progress."""
+
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded executor with a configurable cost."""
+
+    def __init__(self, rounds=12, workers=2, queue_size=8, timeout=10):
+        self.rounds = rounds
+        self.timeout = timeout
+        self._configure(workers, queue_size)
+
+    def _configure(self, workers, queue_size):
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = BoundedSemaphore(queue_size)
+
+    def init_app(self, app):
+        """Read cost, pool size and queue bound from `app`'s config."""
+
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', self.timeout)
+
+        self._executor.shutdown(wait=False)
+        self._configure(app.config.get('PASSWORD_HASH_WORKERS', 2),
+                        app.config.get('PASSWORD_HASH_QUEUE', 8))
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # the hash keeps its slot until it finishes
+            raise PasswordHasherBusy() from None
+
+    def hash(self, password):
+        """Hash `password` at the configured cost."""
+
+        hashed = self._run(bcrypt.generate_password_hash, password, self.rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the stored `hashed` password?"""
+
+        return self._run(bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than the configured one?"""
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+password_hasher = PasswordHasher()
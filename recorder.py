@@ -0,0 +1,145 @@
+"""Record sampled production traffic for replaying with loadtest/replay.py.
+
+When TRAFFIC_LOG names a file, a WSGI middleware appends one JSON line per
+sampled request:
+
+    {"t": 1571234567.123, "method": "GET", "path": "/users/12?before=...",
+     "user": "5be1c0aa9e3f2d41", "status": 200, "ms": 12.4, "bytes": 5301}
+
+`user` is an HMAC of the logged-in user's id (null when logged out), so
+one user's requests can be told apart without saying who they are.
+Request bodies aren't recorded. Sampling is per user: a sampled user has
+all of their requests recorded, keeping their sessions whole.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import random
+import time
+from threading import Lock
+
+from werkzeug.http import parse_cookie
+
+from current_user import session_user_id
+
+
+class TrafficRecorder:
+    """WSGI middleware appending sampled requests to a JSONL file."""
+
+    def __init__(self, wsgi_app, flask_app, path, sample_rate=1.0,
+                 secret=None, skip=('/static/',)):
+        self.wsgi_app = wsgi_app
+        self.flask_app = flask_app
+        self.path = path
+        self.sample_rate = sample_rate
+        self.secret = (secret or flask_app.secret_key).encode()
+        self.skip = tuple(skip)
+        self._fd = None
+        self._lock = Lock()
+
+    def anonymize(self, user_id):
+        return hmac.new(self.secret, str(user_id).encode(),
+                        hashlib.sha256).hexdigest()[:16]
+
+    def sampled(self, user):
+        """Whether to record a request from `user` (an anonymized id)."""
+
+        if self.sample_rate >= 1:
+            return True
+        if user is None:
+            return random.random() < self.sample_rate
+        return int(user, 16) / 16 ** len(user) < self.sample_rate
+
+    def write(self, entry):
+        line = (json.dumps(entry, separators=(',', ':')) + '\n').encode()
+
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.path,
+                                   os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                   0o600)
+            # a single O_APPEND write, so worker processes sharing the
+            # file don't interleave lines
+            os.write(self._fd, line)
+
+    def start(self, method, path, query, cookie):
+        """The log entry for a request, or None if it isn't sampled.
+
+        `cookie` is the Cookie header. Pass the entry to finish() once the
+        response is sent.
+        """
+
+        if path.startswith(self.skip):
+            return None
+
+        user_id = session_user_id(
+            self.flask_app,
+            parse_cookie(cookie).get(self.flask_app.session_cookie_name))
+        user = self.anonymize(user_id) if user_id is not None else None
+
+        if not self.sampled(user):
+            return None
+
+        return {
+            't': round(time.time(), 3),
+            'method': method,
+            'path': f"{path}?{query}" if query else path,
+            'user': user,
+            'started': time.perf_counter(),
+        }
+
+    def finish(self, entry, status, size):
+        """Log a request begun with start(): its status and bytes sent."""
+
+        started = entry.pop('started')
+        entry['status'] = status
+        entry['ms'] = round((time.perf_counter() - started) * 1000, 2)
+        entry['bytes'] = size
+        self.write(entry)
+
+    def __call__(self, environ, start_response):
+        entry = self.start(environ.get('REQUEST_METHOD'),
+                           environ.get('PATH_INFO', ''),
+                           environ.get('QUERY_STRING'),
+                           environ.get('HTTP_COOKIE', ''))
+
+        if entry is None:
+            return self.wsgi_app(environ, start_response)
+
+        status = []
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(' ', 1)[0]))
+            return start_response(status_line, headers, exc_info)
+
+        body = self.wsgi_app(environ, recording_start_response)
+        return self.record(body, entry, status)
+
+    def record(self, body, entry, status):
+        """Pass `body` through, logging `entry` once it's all been sent."""
+
+        size = 0
+        try:
+            for chunk in body:
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+            self.finish(entry, status[-1] if status else None, size)
+
+
+def init_traffic_log(app):
+    """Record `app`'s traffic to TRAFFIC_LOG, if set."""
+
+    path = app.config.get('TRAFFIC_LOG')
+    if path:
+        app.wsgi_app = TrafficRecorder(
+            app.wsgi_app, app, path,
+            sample_rate=app.config.get('TRAFFIC_SAMPLE_RATE', 1.0),
+            secret=app.config.get('TRAFFIC_LOG_SECRET'))
+        # asgi.py records the requests it answers itself through this too
+        app.extensions['traffic_recorder'] = app.wsgi_app
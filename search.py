@@ -0,0 +1,286 @@
+"""User and message search for Warbler.
+
+On Postgres, username substring matches are served by a pg_trgm GIN index
+and ranked by trigram similarity, typeahead prefix lookups use a
+lower(username) text_pattern_ops index, and message text is searched
+through a GIN index on its tsvector (see the DDL in models.py). Other
+databases (SQLite in development) fall back to LIKE for users and to an
+in-process inverted index for messages.
+"""
+
+import re
+from collections import defaultdict
+from threading import Lock
+
+from sqlalchemy import func, case, or_, literal_column
+from sqlalchemy.orm import joinedload
+
+from models import db, User, Message
+
+# Users per page of search results / directory listing
+USER_PAGE_SIZE = 24
+
+# Never page past this many ranked results for one search
+MAX_USER_RESULTS = 240
+
+# Suggestions returned by typeahead
+TYPEAHEAD_LIMIT = 8
+
+# Messages per page of message search results
+MESSAGE_PAGE_SIZE = 20
+
+# Only the most recent this-many matches of a message search are ranked,
+# which keeps common words as cheap as rare ones
+MAX_MESSAGE_CANDIDATES = 1000
+
+# Never page past this many ranked message results
+MAX_MESSAGE_RESULTS = 200
+
+# Text search configuration; must match the index in models.py
+TEXT_SEARCH_CONFIG = 'english'
+
+# Columns searched by search_users. Only username has a trigram index on
+# Postgres; index any column added here (see models.py and migrations.py)
+USER_SEARCH_FIELDS = ('username',)
+
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def escape_like(term):
+    """Escape LIKE wildcards so `term` only matches literally."""
+
+    return (term.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+def search_users(term, page=1, fields=USER_SEARCH_FIELDS):
+    """One page of users matching `term`, best matches first.
+
+    Exact username matches rank first, then username prefixes, then the
+    rest by trigram similarity (Postgres) or username length. Returns
+    (users, has_next); results stop at MAX_USER_RESULTS.
+    """
+
+    term = term.strip()
+    pattern = f"%{escape_like(term)}%"
+    columns = [getattr(User, field) for field in fields]
+
+    lowered = func.lower(User.username)
+    ranking = [
+        case([(lowered == term.lower(), 0),
+              (lowered.like(f"{escape_like(term.lower())}%", escape='\\'), 1)],
+             else_=2),
+    ]
+
+    if is_postgres():
+        ranking.append(func.similarity(User.username, term).desc())
+    else:
+        ranking.append(func.length(User.username))
+
+    offset = (page - 1) * USER_PAGE_SIZE
+    limit = min(USER_PAGE_SIZE, MAX_USER_RESULTS - offset)
+
+    if limit <= 0:
+        return [], False
+
+    users = (User
+             .query
+             .filter(or_(*[column.ilike(pattern, escape='\\')
+                           for column in columns]))
+             .order_by(*ranking, User.id)
+             .offset(offset)
+             .limit(limit + 1)
+             .all())
+
+    has_next = (len(users) > limit
+                and offset + limit < MAX_USER_RESULTS)
+
+    return users[:limit], has_next
+
+
+def list_users_after(after_id=None):
+    """One page of the unfiltered directory, keyed on user id.
+
+    Returns (users, next_after_id); next_after_id is None on the last page.
+    """
+
+    query = User.query
+
+    if after_id:
+        query = query.filter(User.id > after_id)
+
+    users = query.order_by(User.id).limit(USER_PAGE_SIZE + 1).all()
+
+    if len(users) > USER_PAGE_SIZE:
+        users = users[:USER_PAGE_SIZE]
+        return users, users[-1].id
+
+    return users, None
+
+
+def typeahead_users(prefix, limit=TYPEAHEAD_LIMIT):
+    """Users whose username starts with `prefix` (case-insensitive)."""
+
+    prefix = prefix.strip().lower()
+
+    if not prefix:
+        return []
+
+    return (User
+            .query
+            .filter(func.lower(User.username)
+                    .like(f"{escape_like(prefix)}%", escape='\\'))
+            .order_by(func.lower(User.username))
+            .limit(limit)
+            .all())
+
+
+def tokenize(text):
+    """Lowercased word tokens of `text`, for the in-process index."""
+
+    return re.findall(r"\w+", text.lower())
+
+
+class MessageIndex:
+    """In-process inverted index of message text (token -> message ids).
+
+    Used when the database has no full-text search. It's built from the
+    messages table on first use and kept current by index_message and
+    unindex_message; rows written around the app (seeding, bulk deletes)
+    only show up after reset().
+    """
+
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._built = False
+        self._lock = Lock()
+
+    def _add(self, message_id, text):
+        for token in tokenize(text):
+            counts = self._postings[token]
+            counts[message_id] = counts.get(message_id, 0) + 1
+
+    def _ensure_built(self):
+        if self._built:
+            return
+
+        for message_id, text in db.session.query(Message.id, Message.text):
+            self._add(message_id, text)
+
+        self._built = True
+
+    def add(self, message):
+        with self._lock:
+            if self._built:
+                self._add(message.id, message.text)
+
+    def remove(self, message):
+        with self._lock:
+            for token in set(tokenize(message.text)):
+                counts = self._postings.get(token)
+                if counts is not None:
+                    counts.pop(message.id, None)
+                    if not counts:
+                        del self._postings[token]
+
+    def reset(self):
+        with self._lock:
+            self._postings.clear()
+            self._built = False
+
+    def search(self, term):
+        """Ids of messages containing every token in `term`, best first.
+
+        Ranked by how often the tokens occur, newest first among equals.
+        """
+
+        tokens = set(tokenize(term))
+        if not tokens:
+            return []
+
+        with self._lock:
+            self._ensure_built()
+
+            postings = [self._postings.get(token, {}) for token in tokens]
+            postings.sort(key=len)
+
+            matches = set(postings[0])
+            for counts in postings[1:]:
+                matches &= counts.keys()
+
+            candidates = sorted(matches, reverse=True)[:MAX_MESSAGE_CANDIDATES]
+
+            return sorted(candidates,
+                          key=lambda id: (-sum(c[id] for c in postings), -id))
+
+
+message_index = MessageIndex()
+
+
+def index_message(message):
+    """Make a newly posted message searchable."""
+
+    if not is_postgres():
+        message_index.add(message)
+
+
+def unindex_message(message):
+    """Drop a message that's about to be deleted from search."""
+
+    if not is_postgres():
+        message_index.remove(message)
+
+
+def search_messages(term, page=1):
+    """One page of messages matching every word of `term`, best first.
+
+    Returns (messages, has_next). Only the newest MAX_MESSAGE_CANDIDATES
+    matches are ranked, and results stop at MAX_MESSAGE_RESULTS.
+    """
+
+    offset = (page - 1) * MESSAGE_PAGE_SIZE
+    limit = min(MESSAGE_PAGE_SIZE, MAX_MESSAGE_RESULTS - offset)
+
+    if limit <= 0 or not term.strip():
+        return [], False
+
+    if is_postgres():
+        messages = _search_messages_postgres(term, offset, limit + 1)
+    else:
+        ids = message_index.search(term)[offset:offset + limit + 1]
+        by_id = {msg.id: msg
+                 for msg in (Message.query
+                             .options(joinedload(Message.user))
+                             .filter(Message.id.in_(ids)))}
+        messages = [by_id[id] for id in ids if id in by_id]
+
+    has_next = (len(messages) > limit
+                and offset + limit < MAX_MESSAGE_RESULTS)
+
+    return messages[:limit], has_next
+
+
+def _search_messages_postgres(term, offset, limit):
+    config = literal_column(f"'{TEXT_SEARCH_CONFIG}'")
+    document = func.to_tsvector(config, Message.text)
+    query = func.plainto_tsquery(config, term)
+
+    candidates = (db.session
+                  .query(Message.id.label('id'),
+                         func.ts_rank(document, query).label('rank'))
+                  .filter(document.op('@@')(query))
+                  .order_by(Message.id.desc())
+                  .limit(MAX_MESSAGE_CANDIDATES)
+                  .subquery())
+
+    return (Message
+            .query
+            .options(joinedload(Message.user))
+            .join(candidates, candidates.c.id == Message.id)
+            .order_by(candidates.c.rank.desc(), Message.id.desc())
+            .offset(offset)
+            .limit(limit)
+            .all())
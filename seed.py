@@ -1,20 +1,176 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+    python seed.py [--data generator] [--workers 4] [--batch-size 10000]
+
+Loads users.csv, messages.csv, follows.csv and (if present) likes.csv from
+the data directory into a freshly created schema. On Postgres each file is
+streamed in with COPY FROM STDIN, tables that only depend on ones already
+loaded are loaded in parallel, and each secondary index is built once the
+table it covers is filled. Other databases get batched executemany inserts.
+"""
+
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from models import User, Message, Follows, Like, Timeline, TIMELINE_LENGTH
+from migrations import stamp, search_indexes, index_pack
+
+# Tables loaded together in each stage; a stage only references tables
+# loaded in earlier ones
+STAGES = [
+    [User],
+    [Message, Follows],
+    [Like],
+]
+
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def csv_columns(model, header):
+    """The CSV header's column names, checked against `model`'s table."""
+
+    columns = [name.strip() for name in header]
+    unknown = set(columns) - set(model.__table__.columns.keys())
+    if unknown:
+        raise ValueError(f"{model.__tablename__}: unknown columns {unknown}")
+    return columns
+
+
+def copy_csv(model, path):
+    """Stream a CSV file into `model`'s table with COPY; returns the row count."""
+
+    with open(path, newline='') as f:
+        columns = csv_columns(model, next(csv.reader([f.readline()])))
+
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            # a crash mid-seed means reseeding anyway
+            cursor.execute("SET synchronous_commit TO off")
+            cursor.copy_expert(f"COPY {model.__tablename__} "
+                               f"({', '.join(columns)}) "
+                               f"FROM STDIN WITH (FORMAT csv)", f)
+            connection.commit()
+            return cursor.rowcount
+        finally:
+            connection.close()
+
+
+def insert_csv(model, path, batch_size):
+    """Insert a CSV file into `model`'s table `batch_size` rows at a time."""
+
+    placeholder = '?' if db.engine.dialect.paramstyle == 'qmark' else '%s'
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = csv_columns(model, next(reader))
+        statement = (f"INSERT INTO {model.__tablename__} "
+                     f"({', '.join(columns)}) "
+                     f"VALUES ({', '.join([placeholder] * len(columns))})")
+
+        connection = db.engine.raw_connection()
+        count = 0
+        try:
+            cursor = connection.cursor()
+            while True:
+                # empty fields are NULLs, as with COPY
+                batch = [[value or None for value in row]
+                         for row in islice(reader, batch_size)]
+                if not batch:
+                    break
+                cursor.executemany(statement, batch)
+                count += len(batch)
+            connection.commit()
+            return count
+        finally:
+            connection.close()
+
+
+def secondary_indexes():
+    """Names of the indexes search_indexes and index_pack build."""
+
+    if is_postgres():
+        query = ("SELECT indexname FROM pg_indexes "
+                 "WHERE schemaname = current_schema() "
+                 "AND indexname LIKE 'ix\\_%'")
+    else:
+        query = ("SELECT name FROM sqlite_master WHERE type = 'index' "
+                 "AND name LIKE 'ix\\_%' ESCAPE '\\'")
+
+    return [name for (name,) in db.session.execute(query)]
+
+
+def load(data_dir, workers, batch_size):
+    """Load every CSV in `data_dir`, stage by stage."""
+
+    for stage in STAGES:
+        jobs = [(model, os.path.join(data_dir, f"{model.__tablename__}.csv"))
+                for model in stage]
+        jobs = [(model, path) for model, path in jobs if os.path.exists(path)]
+
+        if is_postgres():
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                counts = list(executor.map(lambda job: copy_csv(*job), jobs))
+        else:
+            counts = [insert_csv(model, path, batch_size)
+                      for model, path in jobs]
+
+        for (model, path), count in zip(jobs, counts):
+            print(f"{model.__tablename__}: {count} rows")
+
+
+def seed(data_dir='generator', workers=4, batch_size=10000):
+    started = time.monotonic()
+
+    db.drop_all()
+    db.create_all()
+    stamp()
+
+    # indexes are much quicker to build once than to keep up to date
+    # through millions of inserts
+    for name in secondary_indexes():
+        db.session.execute(f"DROP INDEX {name}")
+    db.session.commit()
+
+    load(data_dir, workers, batch_size)
+
+    # bulk loads skip the fan-out and counters kept by the app, so build
+    # counts and timelines here, each before the indexes on what it writes
+    print("building counters")
+    User.recount()
+    db.session.commit()
+
+    print("building indexes")
+    index_pack(concurrently=False, tables=('messages', 'follows', 'likes'))
+
+    print("building timelines")
+    Timeline.rebuild(length=TIMELINE_LENGTH, batch_size=10000)
+    index_pack(concurrently=False, tables=('timelines',))
 
+    search_indexes(concurrently=False)
 
-db.drop_all()
-db.create_all()
+    if is_postgres():
+        with db.engine.connect() as conn:
+            conn.execution_options(isolation_level='AUTOCOMMIT').execute('ANALYZE')
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    print(f"seeded in {time.monotonic() - started:.1f}s")
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data', default='generator',
+                        help="directory holding the CSV files")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="tables loaded at once (Postgres)")
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help="rows per executemany (other databases)")
+    args = parser.parse_args()
 
-db.session.commit()
+    seed(args.data, args.workers, args.batch_size)
@@ -16,52 +16,79 @@ $(function () {
         await updateFollowing($(e.target))
     })
 
+    $("body").on("click", '#load-more', async function (e) {
+        e.preventDefault()
+        await loadMoreMessages($(e.target))
+    })
+
+    let typeaheadTimer = null
+
+    $("#search").on("input", function (e) {
+        clearTimeout(typeaheadTimer)
+        typeaheadTimer = setTimeout(() => suggestUsers($(e.target).val()), 150)
+    })
+
+    async function suggestUsers(prefix) {
+        let $suggestions = $("#search-suggestions")
+        if (!prefix.trim()) {
+            $suggestions.empty()
+            return
+        }
+        let resp = await axios.get("/users/typeahead", { params: { q: prefix } })
+        $suggestions.empty()
+        for (let user of resp.data.users) {
+            $suggestions.append($("<option>").attr("value", user.username))
+        }
+    }
+
+    async function loadMoreMessages($target) {
+        let resp = await axios.get($target.attr("href"))
+        let $page = $("<div>").html(resp.data)
+        $messages.append($page.find("#messages > li"))
+        let $next = $page.find("#load-more")
+        if ($next.length) {
+            $target.attr("href", $next.attr("href"))
+        } else {
+            $target.remove()
+        }
+    }
+
+    // follow and like responses carry the new state and counts, so the
+    // page is updated from them without asking for the counts again
+
     async function updateFollowing($target) {
         post_url = $target.parent().attr("action")
         let resp = await axios.post(post_url)
         if (resp.data.dbupdate) {
-            $target.toggleClass("btn-outline-primary btn-primary")
-            let id = $target.data().userid;
-            if ($target.text().includes("Unfollow")) {
-                $target.text("Follow")
-                $target.parent().attr("action", `/users/follow/${id}`)
-            } else {
+            let id = post_url.split("/").pop()
+            if (resp.data.following) {
+                $target.removeClass("btn-outline-primary").addClass("btn-primary")
                 $target.text("Unfollow")
                 $target.parent().attr("action", `/users/stop-following/${id}`)
+            } else {
+                $target.removeClass("btn-primary").addClass("btn-outline-primary")
+                $target.text("Follow")
+                $target.parent().attr("action", `/users/follow/${id}`)
             }
-            if (userId) {
-                await updateFollowingCount()
+            if (usersOwnPage === "loggedin") {
+                $('#following').text(resp.data.following_count)
             }
-            if (usersOwnPage !== "loggedin") {
-                await updateFollowersCount()
+            if (String(id) === userId) {
+                $('#followers').text(resp.data.followers_count)
             }
-
         }
     }
 
-    async function updateFollowingCount() {
-        let resp = await axios.get(`/users/${userId}/following_count`)
-        $('#following').text(resp.data.count)
-    }
-
-    async function updateFollowersCount() {
-        let resp = await axios.get(`/users/${userId}/followers_count`)
-        $('#followers').text(resp.data.count)
-    }
-
     async function updateStar($target, id) {
-        let resp = await axios.post(`/messages/${id}/like`)
+        let liked = !$target.hasClass("fas")
+        let resp = await axios.post(`/messages/${id}/like`, { liked: liked })
         if (resp.data.dbupdate) {
-            $target.toggleClass("far fas")
-            await updateLikesCount()
-            $('#likes').text()
+            $target.toggleClass("fas", resp.data.liked)
+            $target.toggleClass("far", !resp.data.liked)
+            if (usersOwnPage === "loggedin") {
+                $('#likes').text(resp.data.likes_count)
+            }
         }
     }
 
-    async function updateLikesCount() {
-        let resp = await axios.get(`/users/${userId}/likes_count`)
-        $('#likes').text(resp.data.count)
-    }
-
-
 })
\ No newline at end of file
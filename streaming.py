@@ -0,0 +1,150 @@
+"""Streamed page rendering for Warbler.
+
+Long pages (timelines, profiles, follower lists) are rendered with
+stream_template instead of render_template: the layout head goes out
+straight away and rows are rendered as they're read from the database in
+batches, so the browser starts work sooner and a huge follower list never
+sits in memory as one string. Browsers that accept gzip get the stream
+compressed as it goes.
+
+The rows themselves are StreamedRows, read from a server-side cursor
+STREAM_BATCH_SIZE at a time. They work the same way under render_template,
+which is what's used when STREAM_TEMPLATES is off, and for instrumented
+requests, since the Server-Timing header must be sent before the body.
+"""
+
+import zlib
+from itertools import islice
+
+from flask import (current_app, request, render_template,
+                   stream_with_context)
+
+from models import encode_cursor
+
+# Flush the response at least this often (bytes of HTML)
+BUFFER_SIZE = 16 * 1024
+
+
+class StreamedRows:
+    """The rows of `query`, fetched `batch_size` at a time as they're iterated.
+
+    `on_batch` is called with each batch before its rows are handed out,
+    to look up per-viewer state (likes, follows) for just those rows. With
+    `limit`, the query is expected to fetch one extra row (see page_query):
+    only `limit` rows are produced and `more` tells whether there were more.
+    """
+
+    def __init__(self, query, batch_size=100, on_batch=None, limit=None):
+        self.query = query
+        self.batch_size = batch_size
+        self.on_batch = on_batch
+        self.limit = limit
+        self.more = False
+        self.last = None
+        self.flush_pending = False
+
+    def __iter__(self):
+        results = iter(self.query
+                       .execution_options(stream_results=True)
+                       .yield_per(self.batch_size))
+        remaining = self.limit
+
+        while True:
+            size = self.batch_size
+            if remaining is not None:
+                size = min(size, remaining)
+                if size == 0:
+                    self.more = next(results, None) is not None
+                    return
+
+            batch = list(islice(results, size))
+            if not batch:
+                return
+
+            if remaining is not None:
+                remaining -= len(batch)
+
+            if self.on_batch:
+                self.on_batch(batch)
+
+            self.last = batch[-1]
+            yield from batch[:-1]
+
+            # a good point to send what's rendered so far, before the next
+            # batch is fetched
+            self.flush_pending = True
+            yield batch[-1]
+
+
+class StreamedMessages(StreamedRows):
+    """A page of messages (see page_query) with the cursor to the next one."""
+
+    @property
+    def next_cursor(self):
+        """Cursor for the next page, or None; only known once iterated."""
+
+        if not self.more:
+            return None
+        return encode_cursor(self.last.timestamp, self.last.id)
+
+
+def stream_template(template_name, **context):
+    """Response that renders `template_name` while it's being sent."""
+
+    app = current_app._get_current_object()
+
+    if (not app.config.get('STREAM_TEMPLATES')
+            or app.config.get('SQL_INSTRUMENTATION')):
+        return render_template(template_name, **context)
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    rows = [value for value in context.values()
+            if isinstance(value, StreamedRows)]
+
+    chunks = generate(template, context, rows)
+    # plain or gzipped depending on the request, so caches must key on it
+    headers = {'Vary': 'Accept-Encoding'}
+
+    if 'gzip' in request.accept_encodings:
+        chunks = gzipped(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return app.response_class(stream_with_context(chunks),
+                              mimetype='text/html', headers=headers)
+
+
+def generate(template, context, rows):
+    """Encoded HTML of `template`, in chunks flushed at row batch ends."""
+
+    buffer = []
+    size = 0
+
+    for chunk in template.generate(context):
+        buffer.append(chunk)
+        size += len(chunk)
+
+        flush = size >= BUFFER_SIZE
+        for streamed in rows:
+            if streamed.flush_pending:
+                streamed.flush_pending = False
+                flush = True
+
+        if flush:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def gzipped(chunks):
+    """Gzip a stream, flushing the compressor with every chunk."""
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    yield compressor.flush()
@@ -0,0 +1,197 @@
+"""ASGI JSON endpoint tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import json
+import os
+from unittest import TestCase, skipIf
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from asgi import application
+from current_user import CURR_USER_KEY, session_cookie
+from models import db, User, Message, Follows, Like, Timeline
+
+db.create_all()
+
+
+def call(method, path, cookie=None, body=b'', headers=()):
+    """Send one request through the ASGI app, with its lifespan around it.
+
+    Returns (status, headers dict, body).
+    """
+
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'scheme': 'http',
+        'method': method, 'path': path, 'raw_path': path.encode(),
+        'query_string': b'', 'root_path': '', 'server': ('localhost', 80),
+        'headers': [(b'host', b'localhost')] + [
+            (name.encode(), value.encode()) for name, value in headers],
+    }
+    if cookie:
+        scope['headers'].append((b'cookie', cookie.encode()))
+
+    sent = []
+
+    async def receive_body():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        events = asyncio.Queue()
+        lifespan = asyncio.ensure_future(application(
+            {'type': 'lifespan'}, events.get, send))
+
+        await events.put({'type': 'lifespan.startup'})
+        while {'type': 'lifespan.startup.complete'} not in sent:
+            await asyncio.sleep(0.01)
+
+        await application(scope, receive_body, send)
+
+        await events.put({'type': 'lifespan.shutdown'})
+        await lifespan
+
+    asyncio.run(run())
+
+    start = next(m for m in sent if m['type'] == 'http.response.start')
+    content = b''.join(m.get('body', b'') for m in sent
+                       if m['type'] == 'http.response.body')
+    return (start['status'],
+            {name.decode(): value.decode() for name, value in start['headers']},
+            content)
+
+
+@skipIf(not application.native, "needs asyncpg and Postgres")
+class ASGIEndpointsTestCase(TestCase):
+    """Test the JSON endpoints answered without Flask."""
+
+    def setUp(self):
+        Timeline.query.delete()
+        Like.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("asgi1", "asgi1@test.com", "password", None)
+        u2 = User.signup("asgi2", "asgi2@test.com", "password", None)
+        db.session.commit()
+        self.u1 = u1.id
+        self.u2 = u2.id
+
+        message = Message(text="Async hello", user_id=self.u2)
+        db.session.add(message)
+        db.session.commit()
+        self.message_id = message.id
+
+        with app.test_request_context():
+            self.cookie = session_cookie(
+                app, {CURR_USER_KEY: self.u1}).split(';')[0]
+
+    def test_follow_is_idempotent_and_backfills(self):
+        """Does following twice change things once, timeline included?"""
+
+        for changed in (True, False):
+            status, _, body = call('POST', f'/users/follow/{self.u2}',
+                                   self.cookie)
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body), {
+                'dbupdate': True, 'following': True, 'changed': changed,
+                'following_count': 1, 'followers_count': 1})
+
+        self.assertEqual(Timeline.page_query(self.u1).first().id,
+                         self.message_id)
+
+        status, _, body = call('POST', f'/users/stop-following/{self.u2}',
+                               self.cookie)
+        self.assertEqual(json.loads(body)['followers_count'], 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Timeline.query.count(), 0)
+
+    def test_like_state_and_count(self):
+        """Does the like endpoint set, toggle and count likes?"""
+
+        path = f'/messages/{self.message_id}/like'
+        liked = json.dumps({'liked': True}).encode()
+
+        call('POST', path, self.cookie, liked)
+        status, _, body = call('POST', path, self.cookie, liked)
+        self.assertEqual(json.loads(body), {'dbupdate': True, 'liked': True,
+                                            'changed': False,
+                                            'likes_count': 1})
+
+        status, _, body = call('POST', path, self.cookie)
+        self.assertEqual(json.loads(body)['liked'], False)
+        self.assertEqual(User.query.get(self.u1).likes_count, 0)
+
+    def test_counts_conditional(self):
+        """Are counts answered with an ETag, and 304 when it matches?"""
+
+        status, headers, body = call('GET', f'/users/{self.u2}/followers_count',
+                                     self.cookie)
+        self.assertEqual((status, json.loads(body)), (200, {'count': 0}))
+
+        status, _, _ = call('GET', f'/users/{self.u2}/followers_count',
+                            self.cookie,
+                            headers=[('if-none-match', headers['etag'])])
+        self.assertEqual(status, 304)
+
+    def test_counts_match_flask(self):
+        """Are counts the same bytes and ETag as the Flask endpoint's?"""
+
+        status, headers, body = call('GET', f'/users/{self.u2}/followers_count',
+                                     self.cookie)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1
+
+            resp = c.get(f'/users/{self.u2}/followers_count')
+
+        self.assertEqual(body, resp.get_data())
+        self.assertEqual(headers['etag'], resp.headers['ETag'])
+
+    def test_logged_out_falls_back_to_flask(self):
+        """Is a logged-out request handled by the Flask app?"""
+
+        status, _, _ = call('GET', f'/users/{self.u2}/followers_count')
+
+        self.assertEqual(status, 302)
+
+    def test_deleted_user_falls_back_to_flask(self):
+        """Is a deleted user's cookie redirected by Flask, not written with?"""
+
+        User.query.filter_by(id=self.u1).delete()
+        db.session.commit()
+
+        status, _, _ = call('POST', f'/users/follow/{self.u2}', self.cookie)
+
+        self.assertEqual(status, 302)
+        self.assertEqual(Follows.query.count(), 0)
+
+    def test_instrumentation(self):
+        """Do native responses carry Server-Timing with SQL_INSTRUMENTATION?"""
+
+        app.config['SQL_INSTRUMENTATION'] = True
+        try:
+            status, headers, _ = call('POST', f'/users/follow/{self.u2}',
+                                      self.cookie)
+        finally:
+            app.config['SQL_INSTRUMENTATION'] = False
+
+        self.assertEqual(status, 200)
+        self.assertIn('db;dur=', headers['server-timing'])
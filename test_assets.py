@@ -0,0 +1,64 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from assets import build, asset_path, DIST_DIR, IMMUTABLE
+
+
+class AssetPipelineTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        self.manifest = build(app.static_folder)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(os.path.join(app.static_folder, DIST_DIR))
+
+    def test_build_fingerprints_assets(self):
+        """Are assets renamed by content hash and CSS URLs rewritten?"""
+
+        hashed = self.manifest['stylesheets/style.css']
+        self.assertRegex(hashed, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        with open(os.path.join(app.static_folder, DIST_DIR, hashed)) as f:
+            css = f.read()
+
+        self.assertIn(asset_path(self.manifest, 'images/nav-bg.png'), css)
+
+    def test_serves_precompressed_variant(self):
+        """Is the gzip variant served to browsers that accept it?"""
+
+        url = asset_path(self.manifest, 'warbler.js')
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Cache-Control'], IMMUTABLE)
+        self.assertIn('javascript', resp.headers['Content-Type'])
+        self.assertIn(b'loadMoreMessages', gzip.decompress(resp.get_data()))
+
+        resp = self.client.get(url)
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'loadMoreMessages', resp.get_data())
@@ -0,0 +1,170 @@
+"""Resized image endpoint tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from unittest import TestCase, skipIf
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+import images
+from app import app
+from images import DiskLRUCache, Image, thumb, read_source, VARIANTS
+
+
+class DiskLRUCacheTestCase(TestCase):
+    """Test the size-bounded disk cache."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_evicts_least_recently_used(self):
+        """Past max_bytes, is the entry used longest ago dropped?"""
+
+        cache = DiskLRUCache(self.directory, max_bytes=25)
+        cache.put('a', b'a' * 10)
+        cache.put('b', b'b' * 10)
+        cache.get('a')
+        cache.put('c', b'c' * 10)
+
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), b'c' * 10)
+        self.assertEqual(cache.size, 20)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a', 'c'])
+
+    def test_reloads_index_from_disk(self):
+        """Does a new cache on the same directory see earlier entries?"""
+
+        DiskLRUCache(self.directory, max_bytes=100).put('a', b'data')
+
+        cache = DiskLRUCache(self.directory, max_bytes=100)
+
+        self.assertEqual(cache.get('a'), b'data')
+        self.assertEqual(cache.size, 4)
+
+
+class SourceHandler(BaseHTTPRequestHandler):
+    """/pic is an image; /redirect sends you to it by its IP address."""
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header(
+                'Location', f'http://127.0.0.1:{self.server.server_port}/pic')
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'picture')
+
+    def log_message(self, *args):
+        pass
+
+
+class ReadSourceTestCase(TestCase):
+    """Test fetching source images only from public addresses."""
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), SourceHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        # pretend a name that doesn't resolve is public, at our server
+        self.public_address = images.public_address
+        images.public_address = (
+            lambda host: '127.0.0.1' if host == 'pinned.invalid' else None)
+        self.base = f'http://pinned.invalid:{self.server.server_port}'
+
+    def tearDown(self):
+        images.public_address = self.public_address
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connects_to_vetted_address(self):
+        """Is the fetch made to the address that was checked?"""
+
+        self.assertEqual(read_source(app, f'{self.base}/pic'), b'picture')
+
+    def test_redirect_to_private_address(self):
+        """Is a redirect to a private address refused?"""
+
+        self.assertIsNone(read_source(app, f'{self.base}/redirect'))
+
+    def test_no_pillow_no_redirect(self):
+        """Without Pillow, are static images served and others 404s?"""
+
+        client = app.test_client()
+        pillow, images.Image = images.Image, None
+        try:
+            resp = client.get(thumb('/static/images/default-pic.png',
+                                    'avatar'))
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+
+            resp = client.get(thumb('https://example.com/a.png', 'avatar'))
+            self.assertEqual(resp.status_code, 404)
+        finally:
+            images.Image = pillow
+
+
+@skipIf(Image is None, "Pillow isn't installed")
+class ImageViewsTestCase(TestCase):
+    """Test resizing images through /images/<variant>."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.src = '/static/images/default-pic.png'
+
+    def test_serves_resized_webp(self):
+        """Do browsers accepting WebP get a WebP of the variant's size?"""
+
+        resp = self.client.get(thumb(self.src, 'avatar'),
+                               headers={'Accept': 'image/webp,*/*'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'image/webp')
+        self.assertIn('max-age', resp.headers['Cache-Control'])
+        self.assertEqual(resp.headers['Vary'], 'Accept')
+
+        image = Image.open(BytesIO(resp.get_data()))
+        self.assertEqual(image.format, 'WEBP')
+        self.assertEqual(image.size, VARIANTS['avatar'])
+
+    def test_serves_jpeg_otherwise(self):
+        """Do other browsers get a JPEG, cropped to the variant's shape?"""
+
+        resp = self.client.get(thumb(self.src, 'hero'),
+                               headers={'Accept': 'image/*'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'image/jpeg')
+        self.assertEqual(Image.open(BytesIO(resp.get_data())).size,
+                         VARIANTS['hero'])
+
+    def test_rejects_bad_sources(self):
+        """Are unknown variants, private hosts and paths outside static/ 404s?"""
+
+        for url in [thumb(self.src, 'huge'),
+                    thumb('http://127.0.0.1/secret.png', 'avatar'),
+                    thumb('/static/../app.py', 'avatar'),
+                    thumb('file:///etc/passwd', 'avatar')]:
+            self.assertEqual(self.client.get(url).status_code, 404, url)
@@ -6,9 +6,10 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, User, Message, Follows, Like
+from models import db, User, Message, Follows, Like, Timeline, page_query
 from sqlalchemy.exc import IntegrityError
 
 # BEFORE we import our app, let's set an environmental variable
@@ -22,6 +23,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+from streaming import StreamedMessages
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -40,6 +42,7 @@ class MessageModelTestCase(TestCase):
         User.query.delete()
         Message.query.delete()
         Follows.query.delete()
+        Timeline.query.delete()
 
         u1 = User.signup(
             email="test1@test.com",
@@ -77,4 +80,107 @@ class MessageModelTestCase(TestCase):
 
         self.assertEqual(Message.query.count(), 0)       
 
-    
\ No newline at end of file
+    
+    def test_page_query_by_cursor(self):
+        """Do cursors page through messages newest first without overlap?"""
+
+        for day in (2, 3, 4):
+            self.u1.messages.append(
+                Message(text=f'day {day}', timestamp=datetime(2020, 1, day)))
+        db.session.commit()
+
+        query = Message.query.filter(Message.user_id == self.u1.id)
+
+        first = StreamedMessages(page_query(query, limit=2), limit=2)
+        self.assertEqual([m.text for m in first], ['This is a message', 'day 4'])
+
+        second = StreamedMessages(page_query(query, first.next_cursor, limit=2),
+                                  limit=2)
+        self.assertEqual([m.text for m in second], ['day 3', 'day 2'])
+        self.assertIsNone(second.next_cursor)
+
+    def test_page_query_ignores_bad_cursor(self):
+        """Is a malformed cursor treated as the first page?"""
+
+        self.assertEqual(len(page_query(Message.query, 'garbage').all()), 1)
+
+    def test_rebuild_timelines_capped(self):
+        """Does a capped rebuild keep each user's newest entries only?"""
+
+        u2 = User(username='testuser2', email='test2@test.com',
+                  password='hashedpw')
+        db.session.add(u2)
+        db.session.flush()
+        self.u1.following.append(u2)
+
+        for day in (2, 3, 4):
+            u2.messages.append(
+                Message(text=f'day {day}', timestamp=datetime(2020, 1, day)))
+        db.session.commit()
+
+        Timeline.rebuild(length=2)
+        db.session.commit()
+
+        self.assertEqual([m.text for m in Timeline.page_query(self.u1.id)],
+                         ['This is a message', 'day 4'])
+        self.assertEqual([m.text for m in Timeline.page_query(u2.id)],
+                         ['day 4', 'day 3'])
+
+    def test_trim_timelines(self):
+        """Are timelines grown by fan-out trimmed back to their length?"""
+
+        for day in (2, 3, 4):
+            message = Message(text=f'day {day}', user_id=self.u1.id,
+                              timestamp=datetime(2030, 1, day))
+            db.session.add(message)
+            db.session.flush()
+            Timeline.fan_out(message)
+        db.session.commit()
+
+        Timeline.trim_all(length=2, batch_size=1)
+
+        self.assertEqual([m.text for m in Timeline.page_query(self.u1.id)],
+                         ['day 4', 'day 3'])
+
+    def test_no_self_follows(self):
+        """Are self-follows refused, and old ones kept out of timelines?"""
+
+        with self.assertRaises(ValueError):
+            Follows.add(self.u1.id, self.u1.id)
+
+        db.session.add(Follows(user_being_followed_id=self.u1.id,
+                               user_following_id=self.u1.id))
+        db.session.commit()
+
+        message = Message(text='Mine', user_id=self.u1.id)
+        db.session.add(message)
+        db.session.flush()
+        Timeline.fan_out(message)
+        Timeline.prune(self.u1.id, self.u1.id)
+        db.session.commit()
+        self.assertEqual(Timeline.query.count(), 1)
+
+        Timeline.rebuild()
+        self.assertEqual(Timeline.query.count(), 2)
+
+    def test_rebuild_timelines_in_batches(self):
+        """Does rebuilding a few users at a time give the same timelines?"""
+
+        u2 = User(username='testuser2', email='test2@test.com',
+                  password='hashedpw')
+        db.session.add(u2)
+        db.session.flush()
+        u2.following.append(self.u1)
+        u2.messages.append(Message(text='Own message'))
+        db.session.commit()
+
+        Timeline.rebuild(batch_size=1)
+
+        u1_messages = [id for (id,) in db.session.query(Message.id)
+                       .filter_by(user_id=self.u1.id)]
+        all_messages = [id for (id,) in db.session.query(Message.id)]
+
+        self.assertEqual(
+            sorted(db.session.query(Timeline.user_id, Timeline.message_id)),
+            sorted([(self.u1.id, id) for id in u1_messages] +
+                   [(u2.id, id) for id in all_messages]))
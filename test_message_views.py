@@ -6,9 +6,13 @@
 
 
 import os
+import re
+from datetime import datetime
+from html import unescape
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Follows, Like, Timeline
+from instrumentation import capture_queries
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +25,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from current_user import profile_cache
+from fragments import fragment_cache
+from likes import like_buffer
+from search import message_index
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -40,6 +48,11 @@ class MessageViewTestCase(TestCase):
         """Create test client, add sample data."""
         # db.drop_all()
         db.create_all()
+        profile_cache.clear()
+        fragment_cache.clear()
+        message_index.reset()
+        Timeline.query.delete()
+        Follows.query.delete()
         User.query.delete()
         Message.query.delete()
 
@@ -78,6 +91,126 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
     
+    def test_add_message_fans_out_to_followers(self):
+        """Is a new message pushed into the author's and followers' timelines?"""
+
+        author_id = self.testuser.id
+        follower_id = self.testuser2.id
+
+        follow = Follows(user_being_followed_id=author_id,
+                         user_following_id=follower_id)
+        db.session.add(follow)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post("/messages/new", data={"text": "Fan out"})
+
+            msg = Message.query.one()
+            timeline_users = {entry.user_id for entry in Timeline.query.all()}
+
+            self.assertEqual(timeline_users, {author_id, follower_id})
+            self.assertEqual(Timeline.page_query(follower_id).all(), [msg])
+
+    def test_like_updates_likes_count(self):
+        """Does liking and unliking a message keep likes_count in step?"""
+
+        user_id = self.testuser.id
+        message = Message(text="Likeable", user_id=self.testuser2.id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post(f'/messages/{message_id}/like')
+            resp = c.get(f'/users/{user_id}/likes_count')
+            self.assertEqual(resp.json, {'count': 1})
+
+            c.post(f'/messages/{message_id}/like')
+            resp = c.get(f'/users/{user_id}/likes_count')
+            self.assertEqual(resp.json, {'count': 0})
+
+    def test_like_with_explicit_state_is_idempotent(self):
+        """Does sending the wanted like state twice leave one like?"""
+
+        user_id = self.testuser.id
+        message = Message(text="Likeable", user_id=self.testuser2.id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            url = f'/messages/{message_id}/like'
+            first = c.post(url, json={'liked': True}).json
+            second = c.post(url, json={'liked': True}).json
+
+            self.assertEqual(first, {'dbupdate': True, 'liked': True,
+                                     'changed': True, 'likes_count': 1})
+            self.assertEqual(second, dict(first, changed=False))
+            self.assertEqual(Like.query.count(), 1)
+
+            c.post(url, json={'liked': False})
+            resp = c.post(url, json={'liked': False})
+
+            self.assertEqual(resp.json, {'dbupdate': True, 'liked': False,
+                                         'changed': False, 'likes_count': 0})
+
+    def test_write_behind_likes_coalesce(self):
+        """Are buffered like toggles shown to the liker and written once?"""
+
+        user_id = self.testuser.id
+        author_id = self.testuser2.id
+        message = Message(text="Popular", user_id=author_id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        app.config['LIKE_WRITE_BEHIND'] = True
+        app.config['LIKE_FLUSH_INTERVAL'] = 60
+        like_buffer.init_app(app)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                resp = c.post(f'/messages/{message_id + 1000}/like')
+                self.assertEqual(resp.status_code, 404)
+
+                for _ in range(3):
+                    resp = c.post(f'/messages/{message_id}/like')
+
+                self.assertEqual(resp.json['liked'], True)
+                self.assertEqual(resp.json['likes_count'], 1)
+                self.assertEqual(Like.query.count(), 0)
+
+                resp = c.get(f'/users/{user_id}/likes_count')
+                self.assertEqual(resp.json, {'count': 1})
+
+                html = c.get(f'/users/{author_id}').get_data(as_text=True)
+                self.assertIn(f'<i class="fas fa-star" id="{message_id}">',
+                              html)
+
+            with capture_queries() as stats:
+                like_buffer.flush()
+
+            self.assertEqual(Like.query.count(), 1)
+            self.assertEqual(User.query.get(user_id).likes_count, 1)
+            self.assertEqual(like_buffer.pending(user_id), [])
+            self.assertEqual(stats.count, 2)
+        finally:
+            app.config['LIKE_WRITE_BEHIND'] = False
+            app.config['LIKE_FLUSH_INTERVAL'] = 0.5
+            like_buffer.init_app(app)
+
     def test_view_message(self):
         """View a single message"""
 
@@ -94,6 +227,29 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Hello", html)
 
+    def test_view_message_conditional_get(self):
+        """Is an unchanged message answered with 304?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hello"})
+            msg = Message.query.one()
+
+            resp = c.get(f'/messages/{msg.id}')
+            resp = c.get(f'/messages/{msg.id}',
+                         headers={'If-None-Match': resp.headers['ETag']})
+
+            self.assertEqual(resp.status_code, 304)
+
+    def test_view_missing_message(self):
+        """Is a missing message a 404?"""
+
+        resp = self.client.get('/messages/0')
+
+        self.assertEqual(resp.status_code, 404)
+
     def test_deleted_messages(self):
         """Make sure a deleted message will not show up on page"""
 
@@ -132,3 +288,192 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)     
 
             # ISSUE WITH DB SESSION - THIS COULD USE WORK 
+
+    def test_search_messages(self):
+        """Are posted messages searchable, best match first, until deleted?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get('/messages/search?q=warm')
+
+            c.post("/messages/new", data={"text": "Warbling is warm"})
+            c.post("/messages/new", data={"text": "Warm warm warm day"})
+            c.post("/messages/new", data={"text": "Something else"})
+
+            resp = c.get('/messages/search?q=WARM')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("Something else", html)
+            self.assertLess(html.index("Warm warm warm day"),
+                            html.index("Warbling is warm"))
+
+            msg = Message.query.filter_by(text="Warm warm warm day").one()
+            c.post(f'/messages/{msg.id}/delete')
+
+            resp = c.get('/messages/search?q=warm')
+            self.assertNotIn("Warm warm warm day", resp.get_data(as_text=True))
+
+    def test_cached_message_items_star_per_viewer(self):
+        """Is one cached list item shown with each viewer's own star?"""
+
+        author_id = self.testuser2.id
+        message = Message(text="Starry", user_id=author_id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+        db.session.add(Like(user_id=self.testuser.id, message_id=message_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get(f'/users/{author_id}').get_data(as_text=True)
+            self.assertIn(f'<i class="fas fa-star" id="{message_id}">', html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            html = c.get(f'/users/{author_id}').get_data(as_text=True)
+            self.assertIn("Starry", html)
+            self.assertNotIn('fa-star', html)
+
+        self.assertIsNotNone(fragment_cache.get((message_id, 0)))
+
+    def test_cached_message_items_outlive_author_activity(self):
+        """Do an author's follows and likes leave their list items cached?"""
+
+        author_id = self.testuser2.id
+        message = Message(text="Still cached", user_id=author_id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get(f'/users/{author_id}').get_data()
+            fragment = fragment_cache.get((message_id, 0))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post(f'/users/follow/{self.testuser.id}')
+            self.assertGreater(db.session.query(User.version)
+                               .filter_by(id=author_id).scalar(), 0)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get(f'/users/{author_id}').get_data()
+
+        self.assertIsNotNone(fragment)
+        self.assertEqual(list(fragment_cache._entries), [(message_id, 0)])
+
+    def test_cached_message_items_follow_profile_and_deletes(self):
+        """Do profile edits and deletes reach cached list items?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Cached hello"})
+            message_id = Message.query.one().id
+
+            c.get('/messages/search?q=hello')
+            c.post('/users/profile', data={'username': 'renamed',
+                                           'email': 'renamed@test.com',
+                                           'password': 'testuser'})
+
+            html = c.get('/messages/search?q=hello').get_data(as_text=True)
+            self.assertIn('@renamed', html)
+            self.assertNotIn('@testuser<', html)
+
+            c.post(f'/messages/{message_id}/delete')
+
+        self.assertFalse([key for key in fragment_cache._entries
+                          if key[0] == message_id])
+
+    def test_streamed_profile_links_next_page(self):
+        """Does a streamed profile page end with a working load-more link?"""
+
+        user_id = self.testuser.id
+        db.session.add_all([Message(text=f"Post {i}", user_id=user_id,
+                                    timestamp=datetime(2020, 1, 1, 0, i % 60,
+                                                       i // 60))
+                            for i in range(101)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get(f'/users/{user_id}')
+            self.assertTrue(resp.is_streamed)
+
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count('class="list-group-item"'), 100)
+
+            next_url = re.search(r'href="(/users/\d+\?before=[^"]+)"',
+                                 html).group(1)
+            html = c.get(unescape(next_url)).get_data(as_text=True)
+
+            self.assertEqual(html.count('class="list-group-item"'), 1)
+            self.assertNotIn('id="load-more"', html)
+
+    def count_statements(self, client, url):
+        """Fetch `url` and return how many SQL statements it issued."""
+
+        # read the body inside the capture; pages are streamed
+        with capture_queries() as stats:
+            resp = client.get(url)
+            resp.get_data()
+
+        self.assertEqual(resp.status_code, 200)
+        return stats.count
+
+    def fill_timeline(self, num_authors, prefix):
+        """Put 100 messages from `num_authors` users in testuser's timeline."""
+
+        authors = [User(username=f"{prefix}{i}",
+                        email=f"{prefix}{i}@test.com",
+                        password="HASHED_PASSWORD")
+                   for i in range(num_authors)]
+        db.session.add_all(authors)
+        db.session.flush()
+
+        for i in range(100):
+            msg = Message(text=f"Message {i}",
+                          user_id=authors[i % num_authors].id)
+            db.session.add(msg)
+            db.session.flush()
+            db.session.add(Timeline(user_id=self.testuser.id,
+                                    message_id=msg.id,
+                                    timestamp=msg.timestamp))
+
+        db.session.commit()
+
+    def test_timeline_query_count_independent_of_authors(self):
+        """Does a 100-message page cost the same however many authors it has?"""
+
+        user_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            self.fill_timeline(num_authors=1, prefix='single')
+            one_author = self.count_statements(c, '/')
+
+            Timeline.query.delete()
+            Message.query.delete()
+            db.session.commit()
+
+            self.fill_timeline(num_authors=100, prefix='many')
+            many_authors = self.count_statements(c, '/')
+
+        self.assertEqual(one_author, many_authors)
@@ -0,0 +1,162 @@
+"""Query plan regression checks."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+#
+# They load a large dataset, request each page, and EXPLAIN every SELECT
+# the page ran; a sequential scan over one of the big tables means an
+# access path lost (or never had) its index.
+
+
+import os
+from unittest import TestCase, skipUnless
+
+from models import db, User, Message, Follows, Like, Timeline
+from instrumentation import capture_queries
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+NUM_USERS = 10000
+NUM_MESSAGES = 100000
+FOLLOWS_PER_USER = 5
+LIKES_PER_USER = 5
+
+BIG_TABLES = ('users', 'messages', 'follows', 'likes', 'timelines')
+
+
+@skipUnless(db.engine.dialect.name == 'postgresql',
+            "query plans are checked against Postgres")
+class QueryPlanTestCase(TestCase):
+    """EXPLAIN the queries behind each page against a large dataset."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Load the dataset with set-based SQL and refresh statistics."""
+
+        db.session.rollback()
+        Timeline.query.delete()
+        Like.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        db.session.execute(f"""
+            INSERT INTO users (email, username, password)
+            SELECT 'plan' || i || '@test.com', 'planuser' || i, 'x'
+            FROM generate_series(1, {NUM_USERS}) AS i""")
+
+        first_user = db.session.query(db.func.min(User.id)).scalar()
+
+        db.session.execute(f"""
+            INSERT INTO messages (text, timestamp, user_id)
+            SELECT 'message ' || i,
+                   now() - i * interval '1 minute',
+                   {first_user} + i % {NUM_USERS}
+            FROM generate_series(1, {NUM_MESSAGES}) AS i""")
+
+        first_message = db.session.query(db.func.min(Message.id)).scalar()
+
+        db.session.execute(f"""
+            INSERT INTO follows (user_being_followed_id, user_following_id)
+            SELECT {first_user} + (u + k * 997) % {NUM_USERS},
+                   {first_user} + u
+            FROM generate_series(0, {NUM_USERS - 1}) AS u,
+                 generate_series(1, {FOLLOWS_PER_USER}) AS k""")
+
+        db.session.execute(f"""
+            INSERT INTO likes (user_id, message_id)
+            SELECT {first_user} + u,
+                   {first_message} + (u * 13 + k * 101) % {NUM_MESSAGES}
+            FROM generate_series(0, {NUM_USERS - 1}) AS u,
+                 generate_series(1, {LIKES_PER_USER}) AS k""")
+
+        Timeline.rebuild()
+        User.recount()
+        db.session.commit()
+
+        for table in BIG_TABLES:
+            db.session.execute(f"ANALYZE {table}")
+        db.session.commit()
+
+        cls.user_id = first_user
+        cls.other_id = first_user + 997
+        cls.message_id = first_message
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.rollback()
+        Timeline.query.delete()
+        Like.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def sequential_scans(self, url):
+        """Fetch `url` and return the big tables its queries seq scan."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            # read the body inside the capture; pages are streamed
+            with capture_queries() as stats:
+                resp = c.get(url)
+                resp.get_data()
+
+        self.assertEqual(resp.status_code, 200, url)
+
+        scanned = set()
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for statement, parameters in stats.statements:
+                if not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+
+                cursor.execute(f"EXPLAIN {statement}", parameters)
+                for (line,) in cursor.fetchall():
+                    for table in BIG_TABLES:
+                        if f"Seq Scan on {table}" in line:
+                            scanned.add(table)
+        finally:
+            connection.close()
+
+        return scanned
+
+    def test_pages_use_indexes(self):
+        """Do the queries behind each page avoid sequential scans?"""
+
+        urls = [
+            '/',
+            f'/users/{self.other_id}',
+            f'/users/{self.other_id}/likes',
+            f'/users/{self.other_id}/following',
+            f'/users/{self.other_id}/followers',
+            f'/users/{self.other_id}/likes_count',
+            f'/users/{self.other_id}/following_count',
+            f'/users/{self.other_id}/followers_count',
+            f'/messages/{self.message_id}',
+            '/users',
+            '/users?q=planuser12',
+            '/users/typeahead?q=planuser12',
+            '/messages/search?q=12345',
+        ]
+
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.sequential_scans(url), set())
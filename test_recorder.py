@@ -0,0 +1,96 @@
+"""Traffic recorder tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recorder.py
+
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from models import db, User
+from recorder import TrafficRecorder
+
+db.create_all()
+
+
+class TrafficRecorderTestCase(TestCase):
+    """Test recording sampled requests to a JSONL file."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'traffic.jsonl')
+        self.wsgi_app = app.wsgi_app
+
+        User.query.delete()
+        user = User.signup(username="recorded", email="recorded@test.com",
+                           password="password", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        app.wsgi_app = self.wsgi_app
+        shutil.rmtree(self.directory)
+
+    def record(self, **kwargs):
+        app.wsgi_app = TrafficRecorder(self.wsgi_app, app, self.path,
+                                       **kwargs)
+
+    def entries(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_records_requests_with_anonymized_user(self):
+        """Are requests logged with timing and size, users by an HMAC?"""
+
+        self.record()
+
+        with app.test_client() as c:
+            # requests are logged once their bodies have been read
+            c.get('/login?next=%2F').get_data()
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            counted_body = c.get(f'/users/{self.user_id}/likes_count').data
+            c.get(f'/users/{self.user_id}').get_data()
+            c.get('/static/stylesheets/style.css').get_data()
+
+        anonymous, counted, profile = self.entries()
+
+        self.assertEqual(anonymous['path'], '/login?next=%2F')
+        self.assertIsNone(anonymous['user'])
+        self.assertEqual(counted['method'], 'GET')
+        self.assertEqual(counted['status'], 200)
+        self.assertEqual(counted['bytes'], len(counted_body))
+        self.assertGreaterEqual(counted['ms'], 0)
+
+        self.assertEqual(counted['user'], profile['user'])
+        self.assertEqual(counted['user'],
+                         app.wsgi_app.anonymize(self.user_id))
+        self.assertEqual(len(counted['user']), 16)
+
+    def test_samples_whole_users(self):
+        """Is each user either always or never recorded?"""
+
+        self.record(sample_rate=0.5)
+        recorder = app.wsgi_app
+
+        sampled = [recorder.sampled(recorder.anonymize(id))
+                   for id in range(1000)]
+
+        self.assertTrue(300 < sum(sampled) < 700)
+        self.assertEqual(sampled, [recorder.sampled(recorder.anonymize(id))
+                                   for id in range(1000)])
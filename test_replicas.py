@@ -0,0 +1,98 @@
+"""Read replica routing tests."""
+
+# run these tests like (with a second, empty database for the replica):
+#
+#    createdb warbler-test-replica
+#    python -m unittest test_replicas.py
+
+
+import os
+import time
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, PRIMARY_UNTIL_KEY
+from models import db, User, Message, Like
+
+app.config['SQLALCHEMY_BINDS'] = {
+    'replica': "postgresql:///warbler-test-replica",
+}
+
+db.create_all()
+replica = db.get_engine(app, bind='replica')
+db.metadata.create_all(replica)
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test that reads use the replica, except just after a write."""
+
+    def setUp(self):
+        app.config['READ_REPLICAS'] = ['replica']
+
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        user = User.signup(username="reader", email="reader@test.com",
+                           password="password", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        message = Message(text="Hi", user_id=user.id)
+        db.session.add(message)
+        db.session.commit()
+        self.message_id = message.id
+
+        # the replica has the same user, with a count it hasn't caught up on
+        with replica.begin() as conn:
+            for table in (Like, Message, User):
+                conn.execute(table.__table__.delete())
+            conn.execute(User.__table__.insert(), id=user.id,
+                         username="reader", email="reader@test.com",
+                         password=user.password, likes_count=5)
+
+    def tearDown(self):
+        app.config['READ_REPLICAS'] = []
+
+    def likes_count(self, client):
+        return client.get(f'/users/{self.user_id}/likes_count').json['count']
+
+    def test_reads_from_replica_until_a_write(self):
+        """Do GETs read the replica, but the primary right after a write?"""
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.assertEqual(self.likes_count(client), 5)
+
+        client.post(f'/messages/{self.message_id}/like',
+                    json={'liked': True})
+        self.assertEqual(self.likes_count(client), 1)
+
+        with client.session_transaction() as sess:
+            self.assertGreater(sess[PRIMARY_UNTIL_KEY], time.time())
+            sess[PRIMARY_UNTIL_KEY] = time.time() - 1
+
+        self.assertEqual(self.likes_count(client), 5)
+
+    def test_no_replicas_reads_primary(self):
+        """Without READ_REPLICAS, is everything read from the primary?"""
+
+        app.config['READ_REPLICAS'] = []
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.assertEqual(self.likes_count(client), 0)
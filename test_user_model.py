@@ -9,6 +9,7 @@ import os
 from unittest import TestCase
 
 from models import db, User, Message, Follows, Like
+from passwords import password_hasher, PasswordHasher, PasswordHasherBusy
 from sqlalchemy.exc import IntegrityError
 
 # BEFORE we import our app, let's set an environmental variable
@@ -118,6 +119,48 @@ class UserModelTestCase(TestCase):
 
         self.assertEqual(self.u2.is_followed_by(self.u1), True)
     
+    def test_user_following_ids(self):
+        """Does following_ids return the followed ids, limited to `among`?"""
+
+        self.assertEqual(self.u1.following_ids(), set())
+
+        self.u1.following.append(self.u2)
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_ids(), {self.u2.id})
+        self.assertEqual(self.u1.following_ids(among=[self.u1.id]), set())
+        self.assertEqual(self.u2.following_ids(), set())
+
+    def test_user_liked_ids(self):
+        """Does liked_ids only report likes among the given message ids?"""
+
+        liked = Message(text='liked')
+        other = Message(text='not liked')
+        self.u2.messages.extend([liked, other])
+        self.u1.liked_messages.append(liked)
+        db.session.commit()
+
+        self.assertEqual(self.u1.liked_ids([liked.id, other.id]), {liked.id})
+        self.assertEqual(self.u1.liked_ids([other.id]), set())
+
+    def test_recount(self):
+        """Does recount rebuild the counters from the source tables?"""
+
+        message = Message(text='counted')
+        self.u2.messages.append(message)
+        self.u1.following.append(self.u2)
+        self.u1.liked_messages.append(message)
+        db.session.commit()
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u1.likes_count, 1)
+        self.assertEqual(self.u1.messages_count, 0)
+        self.assertEqual(self.u2.followers_count, 1)
+        self.assertEqual(self.u2.messages_count, 1)
+
     def test_bad_user_creation_password(self):
         """Test invalid password given to User creation"""
 
@@ -210,4 +253,42 @@ class UserModelTestCase(TestCase):
 
         user1 = User.authenticate(self.u1.username, 'badpassword')
 
-        self.assertFalse(user1)       
\ No newline at end of file
+        self.assertFalse(user1)       
+
+    def test_authentication_rehashes_at_new_cost(self):
+        """Does logging in rehash a password stored at another bcrypt cost?"""
+
+        old_rounds = password_hasher.rounds
+        password_hasher.rounds = 4
+        try:
+            self.assertTrue(password_hasher.needs_rehash(self.u1.password))
+
+            user1 = User.authenticate(self.u1.username, self.password)
+            db.session.commit()
+
+            self.assertEqual(user1, self.u1)
+            self.assertTrue(self.u1.password.startswith('$2b$04$'))
+            self.assertTrue(User.authenticate(self.u1.username, self.password))
+        finally:
+            password_hasher.rounds = old_rounds
+
+    def test_password_hasher_backpressure(self):
+        """Does a full hasher refuse work instead of queueing it?"""
+
+        hasher = PasswordHasher(rounds=4, workers=1, queue_size=1)
+        hasher._slots.acquire()
+
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash('password')
+
+        hasher._slots.release()
+        self.assertTrue(hasher.check(hasher.hash('password'), 'password'))
+
+    def test_password_hasher_timeout(self):
+        """Is a hash that takes too long reported as busy?"""
+
+        hasher = PasswordHasher(rounds=14, workers=1, queue_size=1,
+                                timeout=0.01)
+
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash('password')
@@ -5,11 +5,12 @@
 #    python -m unittest test_user_model.py
 
 
+import gzip
 import os
+import re
 from unittest import TestCase
 
-from models import db, User, Message, Follows, Like
-from sqlalchemy.exc import IntegrityError
+from models import db, User, Message, Follows, Like, Timeline
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,6 +23,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from current_user import profile_cache
+from fragments import fragment_cache
+from instrumentation import capture_queries
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -29,6 +33,17 @@ from app import app, CURR_USER_KEY
 
 db.create_all()
 
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+# Most SQL statements each page may issue for the sample data below
+QUERY_BUDGETS = {
+    '/': 4,
+    '/users': 4,
+}
+
 
 class UserViewsTestCase(TestCase):
     """Test views for messages."""
@@ -36,6 +51,9 @@ class UserViewsTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        profile_cache.clear()
+        fragment_cache.clear()
+        Timeline.query.delete()
         User.query.delete()
         Message.query.delete()
         Follows.query.delete()
@@ -91,6 +109,43 @@ class UserViewsTestCase(TestCase):
             self.assertIn(u2uname, html)
             self.assertIn(u3uname, html)
 
+    def test_search_users_ranked(self):
+        """Are search results filtered and the exact match ranked first?"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            user = User(username='user2', email='other@test.com',
+                        password='HASHED_PASSWORD')
+            db.session.add(user)
+            db.session.commit()
+
+            resp = c.get('/users?q=user2')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('@testuser2', html)
+            self.assertNotIn('@testuser1', html)
+            self.assertLess(html.index('@user2<'), html.index('@testuser2<'))
+
+    def test_search_treats_wildcards_literally(self):
+        """Does a '%' in the search only match a literal '%'?"""
+        with app.test_client() as c:
+            resp = c.get('/users?q=%25')
+
+            self.assertIn('Sorry, no users found', resp.get_data(as_text=True))
+
+    def test_users_typeahead(self):
+        """Does typeahead suggest usernames by case-insensitive prefix?"""
+        with app.test_client() as c:
+            resp = c.get('/users/typeahead?q=TestUser')
+            usernames = [user['username'] for user in resp.json['users']]
+
+            self.assertEqual(usernames, ['testuser1', 'testuser2', 'testuser3'])
+
+            resp = c.get('/users/typeahead?q=user')
+            self.assertEqual(resp.json, {'users': []})
+
     def test_user_details(self):
         """test view of user details"""
         with app.test_client() as c:
@@ -153,6 +208,228 @@ class UserViewsTestCase(TestCase):
             self.assertIn(user2.username, html)
             self.assertNotIn(user3.username, html)
 
+    def test_followers_streamed_in_batches(self):
+        """Is a follower list streamed, gzipped, with follow state per batch?"""
+        u1 = self.u1.id
+        u2 = self.u2.id
+        u3 = self.u3.id
+
+        fans = [User(username=f"fan{i}", email=f"fan{i}@test.com",
+                     password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(fans)
+        db.session.flush()
+        fan_ids = [fan.id for fan in fans]
+
+        for follower in [u1, u3] + fan_ids:
+            db.session.add(Follows(user_being_followed_id=u2,
+                                   user_following_id=follower))
+        for followed in [u3, fan_ids[2]]:
+            db.session.add(Follows(user_being_followed_id=followed,
+                                   user_following_id=u1))
+        db.session.commit()
+
+        app.config['STREAM_BATCH_SIZE'] = 2
+        try:
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u1
+
+                resp = c.get(f'/users/{u2}/followers',
+                             headers={'Accept-Encoding': 'gzip'})
+
+                self.assertTrue(resp.is_streamed)
+                self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+                html = gzip.decompress(resp.get_data()).decode('utf-8')
+        finally:
+            app.config['STREAM_BATCH_SIZE'] = 50
+
+        for username in ['testuser1', 'testuser3', 'fan0', 'fan1', 'fan2']:
+            self.assertIn(f'@{username}', html)
+        # u2's own button in the header, then the followers u1 follows
+        self.assertEqual(re.findall(r'/users/stop-following/(\d+)', html),
+                         [str(u2), str(u3), str(fan_ids[2])])
+
+    def test_streamed_pages_vary_on_encoding(self):
+        """Do plain streamed pages say they vary with Accept-Encoding too?"""
+        with app.test_client() as c:
+            resp = c.get(f'/users/{self.u2.id}')
+
+            self.assertTrue(resp.is_streamed)
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+
+    def test_follow_backfills_timeline(self):
+        """Does following a user copy their messages into our timeline?"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+                u1 = self.u1.id
+                u2 = self.u2.id
+
+            c.post(f'/users/follow/{u2}')
+
+            texts = [msg.text for msg in Timeline.page_query(u1)]
+            self.assertEqual(texts, ['This is 2 message'])
+
+            resp = c.get('/')
+            self.assertIn('This is 2 message', resp.get_data(as_text=True))
+
+    def test_stop_following_prunes_timeline(self):
+        """Does unfollowing a user remove their messages from our timeline?"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+                u1 = self.u1.id
+                u2 = self.u2.id
+
+            c.post(f'/users/follow/{u2}')
+            c.post(f'/users/stop-following/{u2}')
+
+            self.assertEqual(Timeline.page_query(u1).all(), [])
+
+    def test_follow_updates_counters(self):
+        """Do follow and unfollow keep both users' counters in step?"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+                u1 = self.u1.id
+                u2 = self.u2.id
+
+            c.post(f'/users/follow/{u2}')
+
+            self.assertEqual(User.query.get(u1).following_count, 1)
+            self.assertEqual(User.query.get(u2).followers_count, 1)
+
+            resp = c.get(f'/users/{u2}/followers_count')
+            self.assertEqual(resp.json, {'count': 1})
+
+            c.post(f'/users/stop-following/{u2}')
+
+            self.assertEqual(User.query.get(u1).following_count, 0)
+            self.assertEqual(User.query.get(u2).followers_count, 0)
+
+    def test_repeated_follows_change_nothing(self):
+        """Are follows and unfollows idempotent, returning the new counts?"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+                u1 = self.u1.id
+                u2 = self.u2.id
+
+            first = c.post(f'/users/follow/{u2}').json
+            second = c.post(f'/users/follow/{u2}').json
+
+            self.assertEqual(first, {'dbupdate': True, 'following': True,
+                                     'changed': True, 'following_count': 1,
+                                     'followers_count': 1})
+            self.assertEqual(second, dict(first, changed=False))
+            self.assertEqual(Follows.query.count(), 1)
+
+            c.post(f'/users/stop-following/{u2}')
+            resp = c.post(f'/users/stop-following/{u2}')
+
+            self.assertEqual(resp.json, {'dbupdate': True, 'following': False,
+                                         'changed': False,
+                                         'following_count': 0,
+                                         'followers_count': 0})
+            self.assertEqual(User.query.get(u1).following_count, 0)
+
+    def test_delete_user_adjusts_likers(self):
+        """Does deleting a user take all their messages off likers' counts?"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+                u1 = self.u1.id
+                u2 = self.u2.id
+
+            second = Message(text='Another message', user_id=u1)
+            db.session.add(second)
+            db.session.commit()
+
+            for message in Message.query.filter_by(user_id=u1):
+                Like.add(u2, message.id)
+            db.session.commit()
+            self.assertEqual(User.query.get(u2).likes_count, 2)
+
+            c.post('/users/delete')
+
+            self.assertIsNone(User.query.get(u1))
+            self.assertEqual(User.query.get(u2).likes_count, 0)
+
+    def test_count_endpoint_uses_cached_viewer(self):
+        """Does a warm profile cache spare the viewer lookup?"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+                u2 = self.u2.id
+
+            c.get('/users')
+
+            with capture_queries() as stats:
+                resp = c.get(f'/users/{u2}/followers_count')
+
+            self.assertEqual(resp.json, {'count': 0})
+            self.assertEqual(stats.count, 1)
+
+    def test_update_profile_invalidates_cache(self):
+        """Does editing the profile show the new username right away?"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            c.get('/users')
+
+            c.post('/users/profile', data={'username': 'renamed',
+                                           'email': 'renamed@test.com',
+                                           'password': 'HASHED_PASSWORD'})
+
+            resp = c.get('/users')
+            self.assertIn('alt="renamed"', resp.get_data(as_text=True))
+
+    def test_profile_conditional_get(self):
+        """Is an unchanged profile answered with 304 until its data changes?"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+                u2 = self.u2.id
+
+            resp = c.get(f'/users/{u2}')
+            etag = resp.headers['ETag']
+            # the same for gzipped and plain copies, so not a strong one
+            self.assertTrue(etag.startswith('W/'))
+
+            resp = c.get(f'/users/{u2}', headers={'If-None-Match': etag,
+                                                  'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            c.post(f'/users/follow/{u2}')
+
+            resp = c.get(f'/users/{u2}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Unfollow', resp.get_data(as_text=True))
+
+    def test_count_endpoint_conditional_get(self):
+        """Do the count endpoints honor If-None-Match?"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+                u2 = self.u2.id
+
+            resp = c.get(f'/users/{u2}/followers_count')
+            etag = resp.headers['ETag']
+
+            resp = c.get(f'/users/{u2}/followers_count',
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_uncached_pages_not_stored(self):
+        """Do pages without a cache policy tell clients not to store them?"""
+        with app.test_client() as c:
+            resp = c.get('/signup')
+
+            self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
     def test_update_profile_not_loggedin(self):
         """test updating the profile when not logged in"""
         with app.test_client() as c:
@@ -195,3 +472,24 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('This is 2 message',html)
 
+
+    def test_query_budgets(self):
+        """Do pages stay within their query budget (via Server-Timing)?"""
+        app.config['SQL_INSTRUMENTATION'] = True
+        try:
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1.id
+                    u1 = self.u1.id
+
+                budgets = dict(QUERY_BUDGETS)
+                budgets[f'/users/{u1}'] = 4
+
+                for url, budget in budgets.items():
+                    resp = c.get(url)
+                    timing = resp.headers['Server-Timing']
+                    count = int(timing.split('desc="')[1].split(' ')[0])
+
+                    self.assertLessEqual(count, budget, url)
+        finally:
+            app.config['SQL_INSTRUMENTATION'] = False